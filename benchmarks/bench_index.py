@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+""" Compare startup time and memory of the cb.xml cache and the cb.db index
+
+Run from a directory that contains doxygen XML output:
+
+    python benchmarks/bench_index.py [--open N]
+
+cb.db and cb.xml are created first if they are missing.  Each case runs in
+its own process, and reports the wall time and the peak RSS of the process.
+
+"""
+import os
+import sys
+import time
+import json
+import resource
+import subprocess
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import doxyparse
+import cbindex
+
+def peakRSS():
+    """ Peak resident set size of this process, in KB
+
+    ru_maxrss survives exec on Linux, so it would include the memory of
+    the parent process.  VmHWM is used instead where available.
+
+    """
+    try:
+        for line in open('/proc/self/status'):
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def runCase(case,count):
+    start=time.time()
+    all=[]
+    if case=='baseline':
+        pass
+    elif case=='xml':
+        all=doxyparse.load()
+        doxyparse.sortAll(all)
+    else:
+        index=cbindex.Index()
+        all=index.modules()
+        if case=='index-open':
+            for module in all[0:count]:
+                for member in module.members:
+                    index.get(member.id)
+    elapsed=time.time()-start
+    return { 'case': case, 'seconds': elapsed, 'rss_kb': peakRSS(), 'modules': len(all) }
+
+def prepare():
+    if not os.path.exists('cb.db'):
+        cbindex.loadIndex()
+    if not os.path.exists('cb.xml'):
+        cbindex.export(cbindex.Index())
+
+def main():
+    import argparse
+    parser=argparse.ArgumentParser()
+    parser.add_argument('--open',type=int,default=3,help='number of modules opened in the index-open case')
+    parser.add_argument('--case',help=argparse.SUPPRESS)
+    args=parser.parse_args()
+    if args.case:
+        print json.dumps(runCase(args.case,args.open))
+        return
+    prepare()
+    results=[]
+    for case in ['baseline','xml','index','index-open']:
+        cmd=[sys.executable,os.path.abspath(__file__),'--case',case,'--open',str(args.open)]
+        out=subprocess.check_output(cmd).strip().split('\n')[-1]
+        results.append(json.loads(out))
+    baseline=results.pop(0)
+    for r in results:
+        r['rss_delta_kb']=r['rss_kb']-baseline['rss_kb']
+    print json.dumps(results,indent=2)
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+""" Measure the memory used per member by the parsed modules
+
+    python benchmarks/bench_memory.py [--modules N] [--members N] [--refs N]
+                                      [--source xml|index] [--corpus DIR]
+
+A corpus is generated in a temporary directory (see corpus.py), unless
+--corpus points to an existing one.  The modules are then loaded with all
+their members, either parsed from the XML files or read from a cb.db
+index, and the growth of the resident set size is reported as JSON,
+together with the number of bytes per member and per reference.  Each
+measure runs in its own process, so the numbers do not include memory
+freed by an earlier step.
+
+"""
+import os
+import gc
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+
+SCRIPT=os.path.abspath(__file__)
+sys.path.insert(0,os.path.dirname(os.path.dirname(SCRIPT)))
+import doxyparse
+import cbindex
+import corpus
+
+def currentRSS():
+    """ Resident set size of this process, in bytes """
+    for line in open('/proc/self/status'):
+        if line.startswith('VmRSS:'):
+            return int(line.split()[1])*1024
+    return 0
+
+def measure(source):
+    """ Load all modules with their members, returns the memory statistics """
+    gc.collect()
+    before=currentRSS()
+    if source=='xml':
+        files=list(doxyparse.listXMLFiles(doxyparse.scanXMLDirs('.')))
+        modules=[m for m in doxyparse.readXMLFiles(files) if not m is None]
+    else:
+        index=cbindex.Index()
+        modules=index.modules()
+        for m in modules:
+            m.members
+    gc.collect()
+    used=currentRSS()-before
+    members=sum([len(m.members) for m in modules])
+    refs=sum([len(member.refs) for m in modules for member in m.members])
+    return { 'source': source, 'modules': len(modules), 'members': members, 'refs': refs,
+             'bytes': used, 'bytes_per_member': float(used)/max(members,1) }
+
+def main():
+    import argparse
+    parser=argparse.ArgumentParser(description='Measure the memory used per member')
+    corpus.addArguments(parser)
+    parser.add_argument('--source',choices=['xml','index'],action='append',
+                        help='where the modules are loaded from (default: both)')
+    parser.add_argument('--corpus',help='use an existing corpus directory instead of generating one')
+    parser.add_argument('--measure',help=argparse.SUPPRESS)
+    args=parser.parse_args()
+    if args.measure:
+        print json.dumps(measure(args.measure))
+        return
+    cwd=os.getcwd()
+    base=args.corpus
+    temp=None
+    if base is None:
+        temp=tempfile.mkdtemp(prefix='cbbench')
+        base=temp
+        corpus.generate(base,args.modules,args.members,args.refs,args.lines,args.seed)
+    results=[]
+    try:
+        os.chdir(base)
+        for source in args.source or ['xml','index']:
+            if source=='index' and not os.path.exists('cb.db'):
+                cbindex.loadIndex().close()
+            cmd=[sys.executable,SCRIPT,'--measure',source]
+            out=subprocess.check_output(cmd).strip().split('\n')[-1]
+            results.append(json.loads(out))
+    finally:
+        os.chdir(cwd)
+        if not temp is None:
+            shutil.rmtree(temp)
+    print json.dumps(results,indent=2)
+
+if __name__=='__main__':
+    main()
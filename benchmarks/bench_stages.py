@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+""" Time each stage of the browser on a synthetic doxygen corpus
+
+    python benchmarks/bench_stages.py [--modules N] [--members N] [--refs N]
+                                      [--lines N] [-j JOBS] [--corpus DIR]
+                                      [--output FILE]
+
+A corpus is generated in a temporary directory (see corpus.py), unless
+--corpus points to an existing one.  The stages are timed separately:
+scanXMLDirs, readXMLDirs, writing and reading cb.xml, CodeTree.loadCodeTree
+on a new and on an existing index, CodeBrowser.loadModule with and without
+the view cache, and CodeView.draw of one screen.  The Qt stages run
+headless (QT_QPA_PLATFORM=offscreen, or under xvfb-run with Qt 4) and are
+reported as skipped if PySide can not be used.  The results are printed
+(or written to FILE) as JSON, so runs of different versions can be
+compared, together with the timers and counters of the instrument module.
+
+"""
+import os
+import sys
+import time
+import json
+import shutil
+import platform
+import tempfile
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import doxyparse
+import instrument
+import corpus
+
+class Stages:
+    """ Collects the timing of the benchmark stages """
+
+    def __init__(self):
+        self.results=[]
+
+    def run(self,name,func,repeat=1):
+        """ Time func, repeat times, and record the mean and best time
+
+        func may return a dict of extra values to report.
+
+        """
+        times=[]
+        extra=None
+        for i in xrange(repeat):
+            start=time.time()
+            extra=func()
+            times.append(time.time()-start)
+        result={ 'stage': name, 'seconds': sum(times)/len(times), 'best': min(times), 'repeat': repeat }
+        if isinstance(extra,dict):
+            result.update(extra)
+        self.results.append(result)
+        print >>sys.stderr,'{:<24} {:10.4f}s'.format(name,result['seconds'])
+        return result
+
+    def skip(self,name,reason):
+        self.results.append({ 'stage': name, 'skipped': reason })
+        print >>sys.stderr,'{:<24} skipped ({})'.format(name,reason)
+
+def ingestStages(stages,jobs):
+    """ Stages that do not need Qt """
+    state={}
+    def scan():
+        state['dirs']=doxyparse.scanXMLDirs('.')
+        return { 'dirs': len(state['dirs']) }
+    def read():
+        state['modules']=doxyparse.readXMLDirs(state['dirs'],jobs)
+        return { 'modules': len(state['modules']) }
+    def save():
+        sources=dict([(f,doxyparse.fileSignature(f)) for f in doxyparse.listXMLFiles(state['dirs'])])
+        doxyparse.ET.ElementTree(doxyparse.save(state['modules'],sources)).write('cb.xml')
+        return { 'bytes': os.path.getsize('cb.xml') }
+    def load():
+        modules,sources=doxyparse.loadCache('cb.xml')
+        return { 'modules': len(modules) }
+    stages.run('scanXMLDirs',scan)
+    stages.run('readXMLDirs',read)
+    stages.run('save',save)
+    stages.run('load',load)
+    os.remove('cb.xml')
+
+def setupQt():
+    """ Returns a QApplication, or the reason why Qt can not be used """
+    os.environ.setdefault('QT_QPA_PLATFORM','offscreen')
+    try:
+        from PySide import QtGui
+        app=QtGui.QApplication.instance()
+        if app is None:
+            app=QtGui.QApplication(sys.argv[0:1])
+        return app,None
+    except Exception,e:
+        return None,str(e)
+
+def qtStages(stages,jobs,count):
+    """ Stages of the user interface """
+    qtStageNames=['loadCodeTree-new','loadCodeTree','loadModule','loadModule-cached','draw']
+    app,error=setupQt()
+    if app is None:
+        for name in qtStageNames:
+            stages.skip(name,error)
+        return
+    from PySide import QtCore
+    from PySide import QtGui
+    import codebrowser
+    for path in ['cb.db','cb.sym']:
+        if os.path.exists(path):
+            os.remove(path)
+    def loadTree():
+        codebrowser.gBrowser=codebrowser.CodeBrowser()
+        codebrowser.gBrowser.tree.loadCodeTree(jobs)
+        return { 'modules': len(codebrowser.gBrowser.tree.model.modules) }
+    stages.run('loadCodeTree-new',loadTree)
+    stages.run('loadCodeTree',loadTree)
+    browser=codebrowser.gBrowser
+    browser.resize(1200,800)
+    browser.show()
+    app.processEvents()
+    modules=browser.tree.model.modules[0:count]
+    def loadModules():
+        for module in modules:
+            browser.loadModule(module)
+        return { 'modules': len(modules) }
+    def coldLoad():
+        browser.cache.clear()
+        browser.path=''
+        return loadModules()
+    stages.run('loadModule',coldLoad)
+    stages.run('loadModule-cached',loadModules)
+    view=browser.edit.code
+    scroll=browser.edit.verticalScrollBar()
+    viewport=browser.edit.viewport()
+    image=QtGui.QImage(viewport.width(),viewport.height(),QtGui.QImage.Format_RGB32)
+    frames=20
+    def draw():
+        for i in xrange(frames):
+            scroll.setValue(scroll.maximum()*i/frames)
+            qp=QtGui.QPainter()
+            qp.begin(image)
+            view.draw(qp,QtCore.QRect(0,scroll.value(),viewport.width(),viewport.height()))
+            qp.end()
+        return { 'frames': frames, 'lines': len(view.text) }
+    stages.run('draw',draw)
+    browser.close()
+
+def main():
+    import argparse
+    parser=argparse.ArgumentParser(description='Time the stages of the browser on a synthetic corpus')
+    corpus.addArguments(parser)
+    parser.add_argument('-j','--jobs',type=int,default=1,help='parser worker processes')
+    parser.add_argument('--open',type=int,default=10,help='modules opened by the loadModule stages')
+    parser.add_argument('--corpus',help='use an existing corpus directory instead of generating one')
+    parser.add_argument('--output',help='write the JSON results to a file')
+    args=parser.parse_args()
+    if args.output:
+        args.output=os.path.abspath(args.output)
+    cwd=os.getcwd()
+    base=args.corpus
+    temp=None
+    stages=Stages()
+    instrument.enable(atExit=False)
+    # Progress messages of the stages must not mix with the JSON output
+    stdout=sys.stdout
+    sys.stdout=sys.stderr
+    if base is None:
+        temp=tempfile.mkdtemp(prefix='cbbench')
+        base=temp
+        stages.run('generate',lambda: { 'lines': corpus.generate(base,args.modules,args.members,args.refs,args.lines,args.seed) })
+    try:
+        os.chdir(base)
+        ingestStages(stages,args.jobs)
+        qtStages(stages,args.jobs,args.open)
+    finally:
+        os.chdir(cwd)
+        if not temp is None:
+            shutil.rmtree(temp)
+        sys.stdout=stdout
+    report={ 'python': platform.python_version(), 'platform': platform.platform(), 'jobs': args.jobs,
+             'corpus': args.corpus or { 'modules': args.modules, 'members': args.members,
+                                        'refs': args.refs, 'lines': args.lines, 'seed': args.seed },
+             'stages': stages.results, 'counters': instrument.counters,
+             'timers': dict([(name,{ 'calls': t[0], 'seconds': t[1], 'max': t[2] })
+                             for name,t in instrument.timers.iteritems()]) }
+    out=json.dumps(report,indent=2)
+    if args.output:
+        f=open(args.output,'w')
+        try:
+            f.write(out+'\n')
+        finally:
+            f.close()
+    else:
+        print out
+
+if __name__=='__main__':
+    main()
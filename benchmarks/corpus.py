@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+""" Generate a synthetic doxygen XML tree for benchmarks
+
+    python benchmarks/corpus.py DIR [--modules N] [--members N] [--refs N] [--lines N]
+
+DIR receives src/modN.c source files and the matching doxygen output in
+doc/xml.  Every module has the given number of function members, each with
+refs references to random members of other modules, and a body of lines
+source lines.  The program listing refers to the callees the same way
+doxygen does, so the tree exercises the whole ingest path.
+
+"""
+import os
+import sys
+import random
+
+def memberId(module,member):
+    return 'mod{}_8c_1a{}'.format(module,member)
+
+def memberName(module,member):
+    return 'func{}_{}'.format(module,member)
+
+def generateModule(base,m,modules,members,refs,lines,rnd):
+    """ Write the source file and the compound XML file of module m
+
+    Returns the number of source lines written.
+
+    """
+    srcpath=os.path.abspath(os.path.join(base,'src','mod{}.c'.format(m)))
+    source=[]
+    listing=[]
+    defs=[]
+    for k in xrange(members):
+        id=memberId(m,k)
+        name=memberName(m,k)
+        line=len(source)+1
+        bodyend=line+lines+1
+        callees=[(rnd.randrange(modules),rnd.randrange(members)) for r in xrange(refs)]
+        defs.append('<memberdef kind="function" id="{}" static="no"><type>int</type>'
+                    '<name>{}</name><argsstring>(int a)</argsstring>'.format(id,name))
+        for cm,ck in callees:
+            defs.append('<references refid="{}" compoundref="mod{}_8c" startline="1">{}</references>'
+                        .format(memberId(cm,ck),cm,memberName(cm,ck)))
+        defs.append('<location file="{0}" line="{1}" column="1" bodyfile="{0}" bodystart="{1}" bodyend="{2}"/>'
+                    '</memberdef>'.format(srcpath,line,bodyend))
+        source.append('int {}(int a)'.format(name))
+        listing.append('<codeline lineno="{0}" refid="{1}" refkind="member"><highlight class="keywordtype">int</highlight>'
+                       '<highlight class="normal"><sp/><ref refid="{1}" kindref="member">{2}</ref>(int<sp/>a)</highlight></codeline>'
+                       .format(line,id,name))
+        source.append('{')
+        listing.append('<codeline lineno="{}"><highlight class="normal">{{</highlight></codeline>'.format(line+1))
+        for j in xrange(lines-1):
+            n=len(source)+1
+            if len(callees)>0:
+                cm,ck=callees[j%len(callees)]
+                source.append('    a = {}(a) + {};'.format(memberName(cm,ck),j))
+                listing.append('<codeline lineno="{}"><highlight class="normal"><sp/><sp/><sp/><sp/>a<sp/>=<sp/>'
+                               '<ref refid="{}" kindref="member">{}</ref>(a)<sp/>+<sp/>{};</highlight></codeline>'
+                               .format(n,memberId(cm,ck),memberName(cm,ck),j))
+            else:
+                source.append('    a = a + {};'.format(j))
+                listing.append('<codeline lineno="{}"><highlight class="normal"><sp/><sp/><sp/><sp/>a<sp/>=<sp/>a<sp/>+<sp/>{};'
+                               '</highlight></codeline>'.format(n,j))
+        source.append('}')
+        listing.append('<codeline lineno="{}"><highlight class="normal">}}</highlight></codeline>'.format(len(source)))
+    xml=['<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n<doxygen version="1.8.17">',
+         '<compounddef id="mod{0}_8c" kind="file" language="C++"><compoundname>mod{0}.c</compoundname>'.format(m),
+         '<sectiondef kind="func">']
+    xml.extend(defs)
+    xml.append('</sectiondef><programlisting>')
+    xml.extend(listing)
+    xml.append('</programlisting><location file="{}"/></compounddef></doxygen>\n'.format(srcpath))
+    f=open(srcpath,'w')
+    try:
+        f.write('\n'.join(source)+'\n')
+    finally:
+        f.close()
+    f=open(os.path.join(base,'doc','xml','mod{}_8c.xml'.format(m)),'w')
+    try:
+        f.write('\n'.join(xml))
+    finally:
+        f.close()
+    return len(source)
+
+def generate(base,modules=100,members=20,refs=3,lines=10,seed=1):
+    """ Generate a corpus in base, returns the number of source lines """
+    rnd=random.Random(seed)
+    for dir in [os.path.join(base,'src'),os.path.join(base,'doc','xml')]:
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+    count=0
+    for m in xrange(modules):
+        count+=generateModule(base,m,modules,members,refs,lines,rnd)
+    f=open(os.path.join(base,'doc','xml','index.xml'),'w')
+    try:
+        f.write('<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n<doxygenindex version="1.8.17"></doxygenindex>\n')
+    finally:
+        f.close()
+    return count
+
+def addArguments(parser):
+    parser.add_argument('--modules',type=int,default=100,help='number of source files')
+    parser.add_argument('--members',type=int,default=20,help='functions per source file')
+    parser.add_argument('--refs',type=int,default=3,help='references per function')
+    parser.add_argument('--lines',type=int,default=10,help='body lines per function')
+    parser.add_argument('--seed',type=int,default=1)
+
+def main():
+    import argparse
+    parser=argparse.ArgumentParser(description='Generate a synthetic doxygen XML tree')
+    parser.add_argument('dir')
+    addArguments(parser)
+    args=parser.parse_args()
+    n=generate(args.dir,args.modules,args.members,args.refs,args.lines,args.seed)
+    print 'Generated {} modules, {} source lines in {}'.format(args.modules,n,args.dir)
+
+if __name__=='__main__':
+    main()
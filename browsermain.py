@@ -2,12 +2,17 @@ from PySide import QtCore
 from PySide import QtGui
 import sys
 import codebrowser
+from doxyparse import parseArgs, setupArgs
 
 def main():
-    app=QtGui.QApplication(sys.argv)
+    args,rest=parseArgs(sys.argv[1:])
+    setupArgs(args)
+    app=QtGui.QApplication(sys.argv[0:1]+rest)
     codebrowser.gBrowser=codebrowser.CodeBrowser()
-    codebrowser.gBrowser.tree.loadCodeTree()
+    codebrowser.gBrowser.cache.setLimits(args.cache_mb*1024*1024)
+    codebrowser.gBrowser.occurrences.workers=args.jobs
     codebrowser.gBrowser.show()
+    codebrowser.gBrowser.tree.startLoading(args.jobs,args.include,args.exclude,args.shards,args.server)
     app.exec_()	
 
 
@@ -2,32 +2,74 @@ from PySide import QtCore
 from PySide import QtGui
 import sys
 
+# Oldest positions are dropped beyond this many
+MAX_ENTRIES=200
 
 class BrowseStack(QtGui.QDockWidget):
-    def __init__(self,parent=None):
+    """ Positions (path,line) visited before each jump
+
+    The list shows the positions to go back to, most recent last.  Going
+    back keeps the position left on a forward list, which the next jump
+    clears.  Rows are inserted and removed one at a time, the model is
+    never rebuilt.
+
+    """
+
+    def __init__(self,parent=None,maxEntries=MAX_ENTRIES):
         super(BrowseStack,self).__init__(parent)
         self.stacklist=QtGui.QListView()
+        self.model=QtGui.QStringListModel(self)
+        self.stacklist.setModel(self.model)
+        self.maxEntries=maxEntries
         self.items=[]
+        self.forwardItems=[]
         self.setWidget(self.stacklist)
-        
-    def updateItems(self):
-        m=self.stacklist.model()
-        model=QtGui.QStringListModel()
-        model.setStringList(self.items)
-        self.stacklist.setModel(model)
-        del m
-        
-    def addItem(self,item):
-        self.items.append(item)
-        self.updateItems()
-        
+
+    def appendRow(self,entry):
+        row=len(self.items)
+        if row>=self.maxEntries:
+            del self.items[0]
+            self.model.removeRows(0,1)
+            row-=1
+        self.items.append(entry)
+        self.model.insertRows(row,1)
+        self.model.setData(self.model.index(row),'{}:{}'.format(*entry))
+
+    def removeLastRow(self):
+        entry=self.items.pop()
+        self.model.removeRows(len(self.items),1)
+        return entry
+
+    def push(self,path,line):
+        """ Record the position left by a jump """
+        self.appendRow((path,line))
+        self.forwardItems=[]
+
     def top(self):
         if len(self.items)==0:
-            return ''
+            return None
         return self.items[-1]
-    
+
     def pop(self):
         if len(self.items)>0:
-            del self.items[-1]
-            self.updateItems()
-    
\ No newline at end of file
+            return self.removeLastRow()
+        return None
+
+    def back(self,current):
+        """ Returns the position to go back to, current is kept for forward """
+        if len(self.items)==0:
+            return None
+        self.forwardItems.append(current)
+        return self.removeLastRow()
+
+    def forward(self,current):
+        """ Returns the position last gone back from, current is kept for back """
+        if len(self.forwardItems)==0:
+            return None
+        self.appendRow(current)
+        return self.forwardItems.pop()
+
+    def clear(self):
+        self.items=[]
+        self.forwardItems=[]
+        self.model.removeRows(0,self.model.rowCount())
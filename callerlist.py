@@ -0,0 +1,30 @@
+from PySide import QtCore
+from PySide import QtGui
+import sys
+
+
+class CallerList(QtGui.QDockWidget):
+    """ Lists the members that reference ("call") the current member """
+
+    def __init__(self,parent=None):
+        super(CallerList,self).__init__('Callers',parent)
+        self.list=QtGui.QListWidget()
+        self.setWidget(self.list)
+        self.callers=[]
+        self.list.itemDoubleClicked.connect(self.onDoubleClick)
+
+    def showCallers(self,member,callers):
+        """ callers are cbindex.Caller rows, their members are loaded when opened """
+        self.callers=callers
+        self.list.clear()
+        self.setWindowTitle('Callers of {}'.format(member.name))
+        for caller in callers:
+            self.list.addItem('{}{}  ({}:{})'.format(caller.name,caller.args,caller.srcname,caller.line))
+
+    def onDoubleClick(self,item):
+        row=self.list.row(item)
+        if row>=0 and row<len(self.callers):
+            member=self.callers[row].member()
+            if not member is None:
+                import codebrowser
+                codebrowser.gBrowser.jumpTo(member)
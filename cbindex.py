@@ -0,0 +1,453 @@
+#!/usr/bin/env python
+import os
+import sys
+import sqlite3
+import logging
+import doxyparse
+import symbols
+import instrument
+from doxyparse import Module, Member, Reference
+
+log=logging.getLogger('cbindex')
+
+SCHEMA='''
+CREATE TABLE IF NOT EXISTS sources(path TEXT PRIMARY KEY, mtime REAL, size INTEGER, hash TEXT);
+CREATE TABLE IF NOT EXISTS modules(key INTEGER PRIMARY KEY, id TEXT, srcpath TEXT, srcname TEXT, xmlpath TEXT);
+CREATE TABLE IF NOT EXISTS members(key INTEGER PRIMARY KEY, module INTEGER, id TEXT, name TEXT,
+                                   args TEXT, filepath TEXT, line INTEGER, bodyend INTEGER);
+CREATE TABLE IF NOT EXISTS refs(member INTEGER, refid TEXT, ident TEXT);
+CREATE TABLE IF NOT EXISTS spans(module INTEGER, line INTEGER, col INTEGER, refid TEXT, ident TEXT);
+CREATE INDEX IF NOT EXISTS modules_id ON modules(id);
+CREATE INDEX IF NOT EXISTS modules_xmlpath ON modules(xmlpath);
+CREATE INDEX IF NOT EXISTS members_module ON members(module);
+CREATE INDEX IF NOT EXISTS members_id ON members(id);
+CREATE INDEX IF NOT EXISTS refs_member ON refs(member);
+CREATE INDEX IF NOT EXISTS refs_refid ON refs(refid);
+CREATE INDEX IF NOT EXISTS spans_module ON spans(module);
+'''
+
+# Bumped when the tables change, older indexes are emptied and built again
+SCHEMA_VERSION=2
+
+class IndexedModule(Module):
+    """ A module whose members are read from the index on first access """
+
+    def __init__(self,index,key,id,srcpath,srcname,xmlpath):
+        self.index=index
+        self.key=key
+        self.id=id
+        self.srcpath=srcpath
+        self.srcname=srcname
+        self.xmlpath=xmlpath
+        self.initMemberData()
+        self.initSpans()
+        self.spansLoaded=False
+
+    def __getattr__(self,name):
+        if name=='members':
+            self.members=self.index.loadMembers(self)
+            return self.members
+        raise AttributeError(name)
+
+    def codeSpans(self):
+        if not self.spansLoaded:
+            self.index.loadSpans(self)
+            self.spansLoaded=True
+        return Module.codeSpans(self)
+
+class Caller:
+    """ A member referencing another member, as listed in the callers panel
+
+    Only what the panel shows is read from the index.  The member itself,
+    with its module, is loaded by member() when the caller is opened.
+
+    """
+
+    def __init__(self,index,key,name,args,line,srcname):
+        self.index=index
+        self.key=key
+        self.name=name
+        self.args=args
+        self.line=line
+        self.srcname=srcname
+
+    def member(self):
+        return self.index.memberByKey(self.key)
+
+class Index:
+    """ SQLite backed index of modules, members and references
+
+    Only the module table is read at startup.  Members and references of
+    a module are loaded when the module members are first accessed, or when
+    one of its members is looked up by id.  The index can be used like the
+    refid to Member dictionary of the browser (in / get).
+
+    """
+
+    def __init__(self,path='cb.db'):
+        self.path=path
+        self.db=sqlite3.connect(path)
+        self.db.text_factory=str
+        self.db.executescript(SCHEMA)
+        version=self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version<SCHEMA_VERSION:
+            with self.db:
+                for table in ['sources','modules','members','refs','spans']:
+                    self.db.execute('DELETE FROM {}'.format(table))
+                self.db.execute('PRAGMA user_version={}'.format(SCHEMA_VERSION))
+        self.reset()
+
+    def reset(self):
+        """ Drop all objects read so far, e.g. after the index was updated """
+        self.moduleList=None
+        self.loaded={}
+        self.members={}
+
+    def close(self):
+        self.db.close()
+
+    def isEmpty(self):
+        row=self.db.execute('SELECT COUNT(*) FROM sources').fetchone()
+        return row[0]==0
+
+    def sources(self):
+        """ Returns the (mtime,size,hash) signatures of the indexed XML files """
+        sources={}
+        for path,mtime,size,h in self.db.execute('SELECT path,mtime,size,hash FROM sources'):
+            sources[path]=(mtime,size,h)
+        return sources
+
+    def xmlDirs(self):
+        """ Returns the directories of the indexed XML files """
+        return set([os.path.dirname(path) for path in self.sources()])
+
+    def moduleRows(self,xmlpath=None):
+        """ Returns the (key,id,srcpath,srcname,xmlpath) of all modules, or of one XML file """
+        if xmlpath is None:
+            return self.db.execute('SELECT key,id,srcpath,srcname,xmlpath FROM modules ORDER BY xmlpath,key')
+        return self.db.execute('SELECT key,id,srcpath,srcname,xmlpath FROM modules WHERE xmlpath=? ORDER BY key',(xmlpath,))
+
+    def modules(self):
+        """ Returns all modules, sorted by source name, without their members """
+        if self.moduleList is None:
+            all=[]
+            for row in self.moduleRows():
+                all.append(IndexedModule(self,*row))
+            all.sort(key=lambda m: m.srcname)
+            self.moduleList=all
+            self.loaded=dict([(m.key,m) for m in all])
+        return self.moduleList
+
+    def refresh(self,xmlpaths):
+        """ Reload the modules of XML files changed by another connection
+
+        Unlike reset, the modules of other files are kept, with their loaded
+        members.  Returns (removed,added) lists of modules.
+
+        """
+        if self.moduleList is None:
+            return [],self.modules()
+        xmlpaths=set(xmlpaths)
+        removed=[m for m in self.moduleList if m.xmlpath in xmlpaths]
+        for module in removed:
+            del self.loaded[module.key]
+        for key in [k for k,m in self.members.iteritems() if m.module.xmlpath in xmlpaths]:
+            del self.members[key]
+        added=[]
+        for xmlpath in xmlpaths:
+            added.extend([IndexedModule(self,*row) for row in self.moduleRows(xmlpath)])
+        for module in added:
+            self.loaded[module.key]=module
+        # Same order as modules(): by source name, then in table order
+        self.moduleList=[m for m in self.moduleList if not m.xmlpath in xmlpaths]+added
+        self.moduleList.sort(key=lambda m: (m.srcname,m.xmlpath,m.key))
+        return removed,added
+
+    def getModule(self,key):
+        if self.moduleList is None:
+            self.modules()
+        return self.loaded.get(key)
+
+    def loadMembers(self,module):
+        """ Read the members and references of a module, sorted by name """
+        refs={}
+        rows=self.db.execute('SELECT member,refid,ident FROM refs WHERE member IN '
+                             '(SELECT key FROM members WHERE module=?) ORDER BY rowid',(module.key,))
+        for key,refid,ident in rows:
+            refs.setdefault(key,[]).append((refid,ident))
+        members=[]
+        rows=self.db.execute('SELECT key,id,name,args,filepath,line,bodyend FROM members '
+                             'WHERE module=? ORDER BY key',(module.key,))
+        for key,id,name,args,filepath,line,bodyend in rows:
+            m=Member(module)
+            m.assign(id,name,line,args,filepath,bodyend,refs.get(key,()))
+            members.append(m)
+            self.members[key]=m
+        members.sort(key=lambda member: member.name)
+        return members
+
+    def loadSpans(self,module):
+        """ Read the code spans of a module, in listing order """
+        rows=self.db.execute('SELECT line,col,refid,ident FROM spans WHERE module=? ORDER BY rowid',(module.key,))
+        for line,col,refid,ident in rows:
+            module.addSpan(line,col,refid,ident)
+
+    def existing(self,refids):
+        """ Returns the subset of refids that are member ids """
+        found=set()
+        refids=list(refids)
+        # Stay below the SQLite limit of 999 parameters
+        for i in xrange(0,len(refids),500):
+            chunk=refids[i:i+500]
+            rows=self.db.execute('SELECT DISTINCT id FROM members WHERE id IN ({})'.format(','.join('?'*len(chunk))),chunk)
+            found.update([row[0] for row in rows])
+        return found
+
+    def memberKey(self,refid):
+        row=self.db.execute('SELECT key,module FROM members WHERE id=? ORDER BY key LIMIT 1',(refid,)).fetchone()
+        return row
+
+    def __contains__(self,refid):
+        return not self.memberKey(refid) is None
+
+    def moduleOf(self,refid):
+        """ Returns the module defining refid, without loading its members """
+        row=self.memberKey(refid)
+        if row is None:
+            return None
+        return self.getModule(row[1])
+
+    def get(self,refid,default=None):
+        """ Returns the member with the given id, loading its module if needed """
+        row=self.memberKey(refid)
+        if row is None:
+            return default
+        key,moduleKey=row
+        if not key in self.members:
+            module=self.getModule(moduleKey)
+            if module is None:
+                return default
+            module.members
+        return self.members.get(key,default)
+
+    def memberByKey(self,key):
+        """ Returns the member with the given table key, loading its module if needed """
+        if not key in self.members:
+            row=self.db.execute('SELECT module FROM members WHERE key=?',(key,)).fetchone()
+            if row is None:
+                return None
+            module=self.getModule(row[0])
+            if module is None:
+                return None
+            module.members
+        return self.members.get(key)
+
+    def callers(self,refid):
+        """ Returns the Callers of refid, sorted by name and source name
+
+        This is a lookup of the refid index of the references table, which
+        is maintained as modules are ingested.  No module is loaded, so the
+        cost only depends on the number of callers.
+
+        """
+        rows=self.db.execute('SELECT DISTINCT members.key,members.name,members.args,members.line,modules.srcname '
+                             'FROM refs JOIN members ON members.key=refs.member '
+                             'JOIN modules ON modules.key=members.module '
+                             'WHERE refs.refid=? ORDER BY members.name,modules.srcname',(refid,))
+        return [Caller(self,*row) for row in rows]
+
+    def callerCount(self,refid):
+        """ Returns the number of members referencing refid """
+        row=self.db.execute('SELECT COUNT(DISTINCT member) FROM refs WHERE refid=?',(refid,)).fetchone()
+        return row[0]
+
+    def symbolRows(self):
+        """ Returns (id,name,args,filepath) of all members """
+        return self.db.execute('SELECT id,name,args,filepath FROM members')
+
+    def update(self,xmlpaths,modules,sources):
+        """ Replace the modules read from the given XML files
+
+        The modules previously read from xmlpaths are dropped, the new
+        modules are stored, and the XML file signatures replaced by sources.
+
+        """
+        db=self.db
+        with db:
+            for xmlpath in xmlpaths:
+                db.execute('DELETE FROM refs WHERE member IN (SELECT key FROM members WHERE module IN '
+                           '(SELECT key FROM modules WHERE xmlpath=?))',(xmlpath,))
+                db.execute('DELETE FROM members WHERE module IN (SELECT key FROM modules WHERE xmlpath=?)',(xmlpath,))
+                db.execute('DELETE FROM spans WHERE module IN (SELECT key FROM modules WHERE xmlpath=?)',(xmlpath,))
+                db.execute('DELETE FROM modules WHERE xmlpath=?',(xmlpath,))
+            for module in modules:
+                self.addModule(module)
+            db.execute('DELETE FROM sources')
+            db.executemany('INSERT INTO sources(path,mtime,size,hash) VALUES (?,?,?,?)',
+                           [(path,)+sig for path,sig in sources.iteritems()])
+        self.reset()
+
+    def addModule(self,module):
+        db=self.db
+        c=db.execute('INSERT INTO modules(id,srcpath,srcname,xmlpath) VALUES (?,?,?,?)',
+                     (module.id,module.srcpath,module.srcname,module.xmlpath))
+        moduleKey=c.lastrowid
+        db.executemany('INSERT INTO spans(module,line,col,refid,ident) VALUES (?,?,?,?,?)',
+                       [(moduleKey,)+span for span in module.codeSpans()])
+        for m in module.members:
+            c=db.execute('INSERT INTO members(module,id,name,args,filepath,line,bodyend) VALUES (?,?,?,?,?,?,?)',
+                         (moduleKey,m.id,m.name,m.args,m.filepath,m.line,m.bodyend))
+            key=c.lastrowid
+            db.executemany('INSERT INTO refs(member,refid,ident) VALUES (?,?,?)',
+                           [(key,r.refid,r.ident) for r in m.refs])
+
+def updateIndex(index,files,workers=1,onParsed=None):
+    """ Parse the added or changed XML files into the index
+
+    files may be a stream: stale files are handed to the parser as soon as
+    they are found.  onParsed(module,parsed,found) is called after each
+    stale file is parsed, with the module (or None if the file is not a
+    compound) and the number of stale files parsed and found so far.
+    Returns the XML files whose modules were replaced or removed.
+
+    """
+    sources=index.sources()
+    newSources={}
+    stale=[]
+    def staleFiles():
+        checks=doxyparse.checkSources(sources,files)
+        while True:
+            # Directory walk and signature checks, per XML file
+            started=instrument.start()
+            checked=next(checks,None)
+            instrument.stop('ingest.walk',started)
+            if checked is None:
+                break
+            filepath,sig,isStale=checked
+            newSources[filepath]=sig
+            if isStale:
+                stale.append(filepath)
+                yield filepath
+    modules=[]
+    # The walk feeds the parser, so this includes ingest.walk (overlapped with -j)
+    with instrument.timed('ingest.scan'):
+        for parsed,module in enumerate(doxyparse.iterXMLFiles(staleFiles(),workers)):
+            if not module is None:
+                modules.append(module)
+            else:
+                instrument.count('ingest.invalid')
+            if not onParsed is None:
+                onParsed(module,parsed+1,len(stale))
+    if newSources==sources:
+        return []
+    removed=[f for f in sources if not f in newSources]
+    if len(stale)>0 or len(removed)>0:
+        log.info("Updated cache: %d files parsed, %d removed",len(stale),len(removed))
+    instrument.count('ingest.stale',len(stale))
+    instrument.count('ingest.removed',len(removed))
+    with instrument.timed('index.write'):
+        index.update(stale+removed,modules,newSources)
+    return stale+removed
+
+def convert(index,xmlpath='cb.xml',include=None,exclude=None):
+    """ Import an existing cb.xml cache into an empty index
+
+    Caches written before XML file signatures were recorded are trusted,
+    as readAll did: the current signatures of their XML files are recorded
+    (see legacySources).  Returns False if nothing was imported.
+
+    """
+    cache=doxyparse.loadCache(xmlpath)
+    if cache is None:
+        log.warning('Cannot read %s, not imported',xmlpath)
+        return False
+    modules,sources=cache
+    if len(sources)==0:
+        modules,sources=legacySources(modules,include,exclude)
+        if len(modules)==0:
+            log.warning('None of the XML files of %s was found, not imported',xmlpath)
+            return False
+        log.info('%s has no file signatures, trusting it for %d XML files',xmlpath,len(sources))
+    index.update([],modules,sources)
+    return True
+
+def legacySources(modules,include=None,exclude=None):
+    """ Match the modules of a cache without signatures with their XML files
+
+    Doxygen names each compound XML file after the compound id, so modules
+    are matched by id with the XML files found now, and the current
+    signature of each file is recorded.  Modules whose file is missing or
+    ambiguous are dropped, their files are parsed again by updateIndex.
+    Returns (modules,sources).
+
+    """
+    byId={}
+    for filepath in doxyparse.listXMLFiles(doxyparse.walkXMLDirs('.',include,exclude)):
+        id=os.path.basename(filepath)[:-len('.xml')]
+        # The same file name in several XML directories can not be told apart
+        byId[id]=None if id in byId else filepath
+    kept=[]
+    sources={}
+    for module in modules:
+        filepath=byId.get(module.id)
+        if filepath is None or filepath in sources:
+            continue
+        try:
+            sig=doxyparse.fileSignature(filepath)
+        except (IOError,OSError):
+            continue
+        module.xmlpath=filepath
+        kept.append(module)
+        sources[filepath]=sig
+    return kept,sources
+
+def export(index,xmlpath='cb.xml'):
+    """ Write the index contents in the cb.xml format """
+    modules=index.modules()
+    sources=index.sources()
+    doxyparse.ET.ElementTree(doxyparse.save(modules,sources)).write(xmlpath)
+
+def loadIndex(path='cb.db',workers=1,include=None,exclude=None):
+    """ Open the index in the current directory and bring it up to date """
+    index=Index(path)
+    refreshIndex(index,workers,include,exclude)
+    return index
+
+def refreshIndex(index,workers=1,include=None,exclude=None,onParsed=None):
+    """ Bring an index up to date with the XML files of the current directory
+
+    A new index is first filled from cb.xml, if one exists, so that only
+    the XML files changed since that cache was written are parsed.  The
+    symbol index is rebuilt whenever the index changes.  include and
+    exclude are directory patterns for the XML directory search, onParsed
+    is passed to updateIndex.  Returns the XML files whose modules changed.
+
+    """
+    path=index.path
+    if index.isEmpty() and os.path.exists('cb.xml'):
+        log.info('Converting cb.xml to %s',path)
+        with instrument.timed('index.convert'):
+            convert(index,'cb.xml',include,exclude)
+    dirs=doxyparse.walkXMLDirs('.',include,exclude,min(max(workers,1),8))
+    with instrument.timed('index.update'):
+        changed=updateIndex(index,doxyparse.listXMLFiles(dirs),workers,onParsed)
+    if changed or not os.path.exists(symbols.symbolPath(path)):
+        with instrument.timed('index.symbols'):
+            symbols.buildSymbols(index)
+    return changed
+
+def main():
+    import argparse
+    parser=argparse.ArgumentParser()
+    parser.add_argument('--convert',action='store_true',help='import cb.xml into cb.db')
+    parser.add_argument('--export',action='store_true',help='write the contents of cb.db to cb.xml')
+    args=parser.parse_args()
+    index=Index()
+    if args.convert and not convert(index):
+        print 'cb.xml was not imported, see the log'
+    if args.export:
+        export(index)
+    index.close()
+
+if __name__=='__main__':
+    main()
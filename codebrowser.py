@@ -1,15 +1,37 @@
 from PySide import QtCore
 from PySide import QtGui
+import os
 import sys
-from codeedit import CodeEditor
+import cgi
+import instrument
+from codeedit import CodeEditor, CodeDocument, lastIdentifier
+from mappedtext import readLines
 from browsestack import BrowseStack
 from codetree import CodeTree
+from symbolfinder import SymbolFinder
+from callerlist import CallerList
+from occurrencelist import OccurrenceList
+from viewcache import ViewCache
+from indexwatcher import IndexWatcher
+from prefetch import Prefetcher
 
 gBrowser=None
 
 def backspacePressed():
     gBrowser.backspacePressed()
 
+def forwardPressed():
+    gBrowser.forwardPressed()
+
+def findSymbolPressed():
+    gBrowser.findSymbol()
+
+def findOccurrencesPressed():
+    gBrowser.findOccurrences()
+
+def dumpStatsPressed():
+    instrument.dump()
+
 class CodeBrowser(QtGui.QMainWindow):
     def __init__(self,parent=None):
         super(CodeBrowser,self).__init__(parent)
@@ -20,58 +42,287 @@ class CodeBrowser(QtGui.QMainWindow):
         self.stack=BrowseStack()
         self.addDockWidget(QtCore.Qt.LeftDockWidgetArea,self.stack)
         self.refs={}
+        self.cache=ViewCache()
         self.tree=CodeTree()
         self.addDockWidget(QtCore.Qt.RightDockWidgetArea,self.tree)
+        self.callers=CallerList()
+        self.addDockWidget(QtCore.Qt.RightDockWidgetArea,self.callers)
+        self.occurrences=OccurrenceList()
+        self.addDockWidget(QtCore.Qt.BottomDockWidgetArea,self.occurrences)
         self.backShortCut=QtGui.QShortcut(self)
         self.backShortCut.setKey(QtGui.QKeySequence(QtCore.Qt.Key_Backspace))
         self.backShortCut.activated.connect(backspacePressed)
         self.backShortCut.setEnabled(True)
+        self.forwardShortCut=QtGui.QShortcut(self)
+        self.forwardShortCut.setKey(QtGui.QKeySequence(QtCore.Qt.SHIFT+QtCore.Qt.Key_Backspace))
+        self.forwardShortCut.activated.connect(forwardPressed)
+        self.forwardShortCut.setEnabled(True)
+        self.finder=SymbolFinder(self)
+        self.findShortCut=QtGui.QShortcut(self)
+        self.findShortCut.setKey(QtGui.QKeySequence(QtCore.Qt.CTRL+QtCore.Qt.Key_T))
+        self.findShortCut.activated.connect(findSymbolPressed)
+        self.findShortCut.setEnabled(True)
+        self.occurrencesShortCut=QtGui.QShortcut(self)
+        self.occurrencesShortCut.setKey(QtGui.QKeySequence(QtCore.Qt.CTRL+QtCore.Qt.SHIFT+QtCore.Qt.Key_F))
+        self.occurrencesShortCut.activated.connect(findOccurrencesPressed)
+        self.occurrencesShortCut.setEnabled(True)
+        self.statsShortCut=QtGui.QShortcut(self)
+        self.statsShortCut.setKey(QtGui.QKeySequence(QtCore.Qt.CTRL+QtCore.Qt.SHIFT+QtCore.Qt.Key_S))
+        self.statsShortCut.activated.connect(dumpStatsPressed)
+        self.statsShortCut.setEnabled(True)
+        self.progress=QtGui.QProgressBar()
+        self.progress.setMaximumWidth(200)
+        self.progress.setFormat('Indexing %v/%m')
+        self.progress.hide()
+        self.statusBar().addPermanentWidget(self.progress)
+        self.watcher=IndexWatcher(self)
+        self.prefetcher=Prefetcher(self)
 
-    def loadModule(self,module):
+    def closeEvent(self,event):
+        self.prefetcher.stop()
+        self.occurrences.stop()
+        self.tree.stopLoading()
+        super(CodeBrowser,self).closeEvent(event)
+
+    def moduleSpans(self,module):
+        """ Returns the highlights of a module at the positions recorded in its listing
+
+        Refs to members of the module on their own line are definitions.
+        Returns None if the module has no program listing.
+        
+        """
+        spans=module.codeSpans()
+        if len(spans)==0:
+            return None
         memberColor=QtGui.QColor(0,64,192)
         refColor=QtGui.QColor(0,192,128)
         unboundColor=QtGui.QColor(192,64,64)
+        definitions=set([(member.id,member.line) for member in module.members])
+        refids=set([refid for line,col,refid,ident in spans])
+        if hasattr(self.refs,'existing'):
+            known=self.refs.existing(refids)
+        else:
+            known=set([refid for refid in refids if refid in self.refs])
+        highlights=[]
+        for line,col,refid,ident in spans:
+            if (refid,line) in definitions:
+                highlights.append((line,col,ident,memberColor,refid))
+            elif refid in known:
+                highlights.append((line,col,ident,refColor,refid))
+            else:
+                highlights.append((line,col,ident,unboundColor,None))
+        return highlights
+
+    def moduleHighlights(self,module):
+        """ Returns the highlights of all members and references of a module """
+        memberColor=QtGui.QColor(0,64,192)
+        refColor=QtGui.QColor(0,192,128)
+        unboundColor=QtGui.QColor(192,64,64)
+        highlights=[]
+        for member in module.members:
+            highlights.append((member.name,member.line,member.line+1,memberColor,member.id))
+            for ref in member.refs:
+                refMember=self.refs.get(ref.refid)
+                if not refMember is None:
+                    name=lastIdentifier(refMember.name)
+                    color=refColor
+                    refid=ref.refid
+                else:
+                    name=lastIdentifier(ref.ident)
+                    color=unboundColor
+                    refid=None
+                if not name is None:
+                    highlights.append((name,member.line,member.bodyend,color,refid))
+        return highlights
+
+    def prepareModule(self,module,prefetched=False):
+        """ Returns the document of a module, with all its highlights applied
+
+        Prepared documents are kept in the view cache, so going back to a
+        module needs no disk access or highlighting.  prefetched documents
+        are prepared ahead of being shown, see ViewCache.
+        
+        """
+        path=module.srcpath
+        mtime=fileTime(path)
+        doc=self.cache.get(path)
+        if not doc is None and doc.mtime!=mtime:
+            # The file was edited since it was prepared
+            self.cache.remove(path)
+            doc=None
+        if doc is None:
+            started=instrument.start()
+            doc=CodeDocument(path,readLines(path),mtime)
+            spans=self.moduleSpans(module)
+            if spans is None:
+                doc.addHighlights(self.moduleHighlights(module))
+            else:
+                doc.addSpans(spans)
+            self.cache.put(path,doc,prefetched)
+            instrument.stop('module.prepare',started)
+        return doc
+
+    def loadModule(self,module):
         path=module.srcpath
         if path!=self.path:
+            started=instrument.start()
             self.path=path
-            self.edit.setText(path,open(path,'r').read())
-            for member in module.members:
-                self.edit.code.addHighlight(member.name,member.line,memberColor,member.id)
-                for ref in member.refs:
-                    if ref.refid in self.refs:
-                        refMember=self.refs.get(ref.refid)
-                        self.edit.code.addRefHighlights(refMember.name,member.line,member.bodyend,refColor,ref.refid)
-                    else:
-                        self.edit.code.addRefHighlights(ref.ident,member.line,member.bodyend,unboundColor,None)
+            self.edit.setDocument(self.prepareModule(module))
+            self.watcher.watchSource(path)
+            instrument.stop('module.load',started)
+            self.prefetcher.start(module)
         
     def gotoMember(self,member):
         self.loadModule(member.module)
         line=member.line
         self.edit.code.setCurrentLine(self.path,line)
+        self.showCallers(member)
+
+    def showCallers(self,member):
+        """ Fill the callers panel from the reverse reference index """
+        index=self.tree.index
+        if not index is None:
+            self.callers.showCallers(member,index.callers(member.id))
+
+    def jumpTo(self,member):
+        """ Jump to a member, pushing the current position on the browse stack """
+        if len(self.path)>0:
+            self.stack.push(self.path,max(self.edit.code.currentLine,1))
+        self.gotoMember(member)
         
     def gotoRef(self,refid,curLine):
         if refid in self.refs:
-            self.stack.addItem("{}:{}".format(self.path,curLine))
+            self.stack.push(self.path,curLine)
             refMember=self.refs.get(refid)
             self.gotoMember(refMember)
             
-    def backspacePressed(self):
-        top=self.stack.top()
-        c=top.split(':')
-        path=c[0]
-        line=int(c[1])
+    def memberTooltip(self,refid):
+        """ Returns the tool tip of a reference: signature, location and counts """
+        member=self.refs.get(refid)
+        if member is None:
+            return None
+        lines=['<b>{}</b>'.format(cgi.escape(member.name+member.args)),
+               cgi.escape('{}:{}'.format(member.module.srcname,member.line))]
+        counts='{} references'.format(len(member.refs))
+        index=self.tree.index
+        if not index is None:
+            counts+=', {} callers'.format(index.callerCount(refid))
+        lines.append(counts)
+        return '<br>'.join(lines)
+
+    def findSymbol(self):
+        if self.tree.isLoading():
+            self.statusBar().showMessage('Symbol search is available once indexing is done',3000)
+        elif not self.tree.index is None:
+            self.finder.find(self.tree.index)
+
+    def findOccurrences(self):
+        """ Search the word under the mouse in all sources, or the word typed in the panel """
+        self.occurrences.show()
+        word=self.edit.code.getCurrentWord()
+        if len(word)>0:
+            self.occurrences.find(word)
+        else:
+            self.occurrences.edit.setFocus()
+
+    def gotoLocation(self,path,line):
+        """ Jump to a line of a source file, pushing the current position on the browse stack """
+        if self.tree.getModule(path,True) is None:
+            return
+        if len(self.path)>0:
+            self.stack.push(*self.currentPosition())
+        self.gotoPosition((path,line))
+
+    def indexProgress(self,parsed,found):
+        self.progress.setMaximum(max(found,1))
+        self.progress.setValue(parsed)
+        self.progress.show()
+
+    def indexReady(self,paths):
+        """ Called when the background index update is done
+
+        paths are the source files whose modules changed, or None if all
+        modules may have changed.
+        
+        """
+        self.progress.hide()
+        if paths is None:
+            # Prepared documents may miss references to modules parsed later
+            self.finder.symbols=None
+            self.cache.clear()
+            self.reloadModule()
+        elif len(paths)>0:
+            self.finder.symbols=None
+            for path in paths:
+                self.cache.remove(path)
+            if self.path in paths:
+                self.reloadModule()
+        self.watcher.watchXMLDirs(self.tree.xmlDirs())
+        self.statusBar().showMessage('Index ready',3000)
+
+    def sourceChanged(self,path):
+        """ Called when a source file changed on disk """
+        self.cache.remove(path)
+        if path==self.path:
+            self.reloadModule()
+
+    def indexFailed(self,message):
+        self.progress.hide()
+        self.statusBar().showMessage('Indexing failed: {}'.format(message))
+
+    def reloadModule(self):
+        """ Prepare the current module again, keeping the current line """
+        module=self.tree.getModule(self.path)
+        if module is None:
+            return
+        line=self.edit.code.currentLine
+        self.path=''
+        self.loadModule(module)
+        if line>0:
+            self.edit.code.setCurrentLine(self.path,line)
+
+    def gotoSymbol(self,refid):
+        """ Jump to a member picked in the symbol finder """
+        member=self.refs.get(refid)
+        if not member is None:
+            self.jumpTo(member)
+
+    def currentPosition(self):
+        return (self.path,max(self.edit.code.currentLine,1))
+
+    def gotoPosition(self,position):
+        path,line=position
         module=self.tree.getModule(path)
         if not module is None:
             self.loadModule(module)
             self.edit.code.setCurrentLine(path,line)
-        self.stack.pop()
-        
 
-def moduleDoubleClick(item):
-    gBrowser.loadModule(item.module)
+    def backspacePressed(self):
+        position=self.stack.back(self.currentPosition())
+        if not position is None:
+            self.gotoPosition(position)
+
+    def forwardPressed(self):
+        position=self.stack.forward(self.currentPosition())
+        if not position is None:
+            self.gotoPosition(position)
+
+
+def fileTime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
 
-def memberDoubleClick(item):
-    gBrowser.gotoMember(item.member)
+def moduleDoubleClick(module):
+    gBrowser.loadModule(module)
+
+def memberDoubleClick(member):
+    gBrowser.gotoMember(member)
 
 def addReference(refid,member):
     gBrowser.refs[refid]=member
+
+def setReferences(refs):
+    """ Use a member lookup (e.g. the index) for resolving reference ids """
+    gBrowser.refs=refs
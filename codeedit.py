@@ -1,9 +1,241 @@
 from PySide import QtCore
 from PySide import QtGui
 import re
+import logging
+import instrument
+from bisect import bisect_left, bisect_right
+from array import array
+from mappedtext import MappedText, readLines
+
+log=logging.getLogger('codeedit')
+
+# Time the mouse rests on a reference before its tool tip is shown
+HOVER_MS=500
 
 identifier = re.compile(r"([^\d\W]\w*)")
 
+def lastIdentifier(name):
+    """ Returns the last identifier of a qualified name (e.g. ns::cls::f) """
+    nameParts=re.findall(identifier,name)
+    if len(nameParts)==0:
+        return None
+    return nameParts[-1]
+
+def isWordAt(text,col,word):
+    """ True if word is in text at col, and not part of a longer identifier """
+    end=col+len(word)
+    if text[col:end]!=word:
+        return False
+    if col>0 and (text[col-1].isalnum() or text[col-1]=='_'):
+        return False
+    return end>=len(text) or not (text[end].isalnum() or text[end]=='_')
+
+def findWord(text,word,col):
+    """ Returns the column of word in text, at or before col if possible
+
+    Columns recorded with tabs expanded are at or after the real ones, so
+    the last occurrence up to col is tried first, then the next one after
+    it.  Returns -1 if word is not on the line.
+    
+    """
+    end=col+len(word)
+    while True:
+        found=text.rfind(word,0,end)
+        if found<0:
+            break
+        if isWordAt(text,found,word):
+            return found
+        end=found+len(word)-1
+    found=text.find(word,col+1)
+    while found>=0:
+        if isWordAt(text,found,word):
+            return found
+        found=text.find(word,found+1)
+    return -1
+
+class CodeDocument:
+    """ The text of a source file, with its highlights
+
+    Holds everything a CodeView needs to show a file that does not depend
+    on the widget, so prepared documents can be cached and swapped in
+    without reading or highlighting the file again.
+    
+    """
+    
+    def __init__(self,path,text,mtime=None):
+        """ text can be either a \n delimited string, a list of line strings
+        or a MappedText
+
+        mtime is the modification time of the file the text was read from.
+        
+        """
+        self.path=path
+        self.mtime=mtime
+        if type(text) is str:
+            self.text=text.split('\n')
+        elif type(text) is list or isinstance(text,MappedText):
+            self.text=text
+        else:
+            raise Exception('Invalid argument to CodeDocument')
+        self.spans={}
+        self.tokens={}
+        self.wordIndex=None
+        self.longest=None
+        # View state, saved when the document is replaced in the view
+        self.scrollPosition=0
+        self.currentLine=-1
+
+    def longestLine(self):
+        """ Returns the longest line (of the lines indexed so far, if mapped) """
+        if isinstance(self.text,MappedText):
+            return self.text.longestLine()
+        if self.longest is None:
+            self.longest=max(self.text,key=len) if len(self.text)>0 else ''
+        return self.longest
+
+    def lineTokens(self,line):
+        """ Returns the identifiers of a line (1 based) as (column,word) pairs
+
+        Each line is tokenized once, the first time it is highlighted.
+        
+        """
+        tokens=self.tokens.get(line)
+        if tokens is None:
+            text=self.text[line-1]
+            tokens=[(m.start(),m.group()) for m in identifier.finditer(text)]
+            self.tokens[line]=tokens
+        return tokens
+
+    def addHighlight(self,name,line,color,refid):
+        """ Highlight all occurrences of identifier name in a line (1 based)
+
+        The line spans, (column,length,color,refid) tuples sorted by column,
+        are updated here so painting and hit testing just walk them.  A new
+        highlight of a name replaces the previous one.
+        
+        """
+        if line<1 or line>len(self.text):
+            return
+        text=self.text[line-1]
+        spans=[span for span in self.spans.get(line,[]) if text[span[0]:span[0]+span[1]]!=name]
+        for col,word in self.lineTokens(line):
+            if word==name:
+                spans.append((col,len(word),color,refid))
+        if len(spans)>0:
+            spans.sort(key=lambda span: span[0])
+            self.spans[line]=spans
+        
+    def identifierIndex(self):
+        """ Returns the identifier occurrences of the whole text
+
+        Maps each identifier to a pair of arrays: the lines (1 based, in
+        ascending order) and columns of its occurrences.  Built once per
+        text, the first time highlights are added in bulk.
+        
+        """
+        if self.wordIndex is None:
+            index={}
+            linenum=0
+            for text in self.text:
+                linenum+=1
+                for m in identifier.finditer(text):
+                    word=m.group()
+                    occ=index.get(word)
+                    if occ is None:
+                        occ=(array('i'),array('i'))
+                        index[word]=occ
+                    occ[0].append(linenum)
+                    occ[1].append(m.start())
+            self.wordIndex=index
+        return self.wordIndex
+
+    def addHighlights(self,highlights):
+        """ Apply many highlights in a single pass
+
+        highlights is a sequence of (name,startLine,endLine,color,refid).
+        Each occurrence of identifier name in lines [startLine,endLine) is
+        highlighted.  Occurrences are looked up in the identifier index, so
+        the cost depends on the number of matches, not on the line ranges.
+        Later entries override earlier ones at the same position.
+        
+        """
+        index=self.identifierIndex()
+        pending={}
+        for name,startLine,endLine,color,refid in highlights:
+            occ=index.get(name)
+            if occ is None:
+                continue
+            lines,cols=occ
+            length=len(name)
+            i=bisect_left(lines,startLine)
+            n=len(lines)
+            while i<n and lines[i]<endLine:
+                line=lines[i]
+                if not line in pending:
+                    pending[line]={}
+                pending[line][cols[i]]=(cols[i],length,color,refid)
+                i+=1
+        for line,added in pending.iteritems():
+            spans=[span for span in self.spans.get(line,[]) if not span[0] in added]
+            spans.extend(added.itervalues())
+            spans.sort(key=lambda span: span[0])
+            self.spans[line]=spans
+
+    def addSpans(self,spans):
+        """ Apply highlights at known positions, without scanning the text
+
+        spans is a sequence of (line,col,ident,color,refid), with line 1
+        based, as recorded from the doxygen program listing.  The listing
+        has tabs expanded, so when ident is not found at its column in an
+        in memory text, its last occurrence before the column is used (see
+        findWord).
+        Memory mapped texts are not read, their columns are trusted.
+        
+        """
+        check=not isinstance(self.text,MappedText)
+        pending={}
+        for line,col,ident,color,refid in spans:
+            if line<1 or line>len(self.text):
+                continue
+            if check:
+                text=self.text[line-1]
+                if not isWordAt(text,col,ident):
+                    col=findWord(text,ident,col)
+                    if col<0:
+                        continue
+            if not line in pending:
+                pending[line]={}
+            pending[line][col]=(col,len(ident),color,refid)
+        for line,added in pending.iteritems():
+            spans=[span for span in self.spans.get(line,[]) if not span[0] in added]
+            spans.extend(added.itervalues())
+            spans.sort(key=lambda span: span[0])
+            self.spans[line]=spans
+
+    def spanAt(self,line,col):
+        """ Returns the highlight span at a line (1 based) and column, or None """
+        for span in self.spans.get(line,[]):
+            if span[0]>col:
+                break
+            if col<span[0]+span[1]:
+                return span
+        return None
+
+    def memorySize(self):
+        """ Rough estimate of the memory used by the document, in bytes """
+        if isinstance(self.text,MappedText):
+            size=self.text.memorySize()
+        else:
+            size=0
+            for line in self.text:
+                size+=len(line)+40
+        for spans in self.spans.itervalues():
+            size+=100*len(spans)+80
+        if not self.wordIndex is None:
+            for lines,cols in self.wordIndex.itervalues():
+                size+=8*len(lines)+200
+        return size
+
 class CodeView(QtGui.QWidget):
     """ A custom widget that shows code, breakpoints and current position """
     
@@ -18,16 +250,23 @@ class CodeView(QtGui.QWidget):
         self.setMinimumSize(QtCore.QSize(200,200))
         self.drawLineNumbers=True
         self.lineNumMargin=0
+        self.text=None
+        self.longestChars=0
+        self.advances={}
         self.setFont(QtGui.QFont('monospace',18))
         self.setMouseTracking(True)
         self.wordUnderCursor=''
-        self.hoverCount=1000
-        self.timer=QtCore.QTimer(self)
-        self.timer.timeout.connect(self.onTimer)
-        self.timer.start(100)
+        # Started when the mouse moves onto a reference, so an idle view
+        # runs no timer
+        self.hoverTimer=QtCore.QTimer(self)
+        self.hoverTimer.setSingleShot(True)
+        self.hoverTimer.setInterval(HOVER_MS)
+        self.hoverTimer.timeout.connect(self.generateTooltip)
         self.hoverPos=QtCore.QPoint(0,0)
-        self.highlights={}
-        self.text=None
+        self.hoverSpan=None
+        self.columnUnderCursor=-1
+        self.doc=None
+        self.spans={}
         self.path=''
         self.fm=None
         
@@ -35,14 +274,41 @@ class CodeView(QtGui.QWidget):
         """ Set the font used to draw text """
         self.font=font
         self.fontMetrics=QtGui.QFontMetrics(self.font)
+        self.charWidths={}
+        self.advances={}
+        self.updateSize()
         self.repaint()
+
+    def updateSize(self):
+        """ Compute the document size and resize the widget to fit it
+
+        Called only when the text or the font change, so painting does not
+        need to measure any line.  The font is monospace, so the widest
+        line is the one with the most characters.
+        
+        """
+        fm=self.fontMetrics
+        self.spacing=fm.lineSpacing()
+        margin=8 * fm.maxWidth()
+        self.lineNumMargin=0
+        if self.drawLineNumbers:
+            self.lineNumMargin=8*fm.maxWidth()
+            margin+=self.lineNumMargin
+        if self.text is None:
+            return
+        longest=self.doc.longestLine()
+        self.longestChars=len(longest)
+        maxWidth=fm.width(longest)
+        boundingHeight=len(self.text)*self.spacing
+        self.boundingRect=QtCore.QRect(0,0,maxWidth,boundingHeight)
+        self.resize(QtCore.QSize(maxWidth+margin,boundingHeight))
         
     def closingApp(self):
         """ Called by application before closing its main window """
-        self.timer.stop()
+        self.hoverTimer.stop()
         
     def load(self,path):
-        self.setText(path,open(path,'r').read())        
+        self.setText(path,readLines(path))
         
     def setText(self,path,text):
         """ Sets the source code text for the current file
@@ -50,33 +316,39 @@ class CodeView(QtGui.QWidget):
         text can be either a \n delimited string, or a list of line strings        
         
         """
-        self.path=path
-        self.highlights={}
-        self.currentLine=-1
-        self.boundingRect=QtCore.QRect(0,0,1,1)
-        if type(text) is str:
-            self.text=text.split('\n')
-        elif type(text) is list:
-            self.text=text
-        else:
-            raise Exception('Invalid argument to CodeView.setText')
+        self.setDocument(CodeDocument(path,text))
+
+    def setDocument(self,doc):
+        """ Show a document, restoring its scroll position and current line """
+        if not self.doc is None:
+            self.doc.scrollPosition=self.scrollArea.verticalScrollBar().value()
+            self.doc.currentLine=self.currentLine
+        self.doc=doc
+        self.path=doc.path
+        self.text=doc.text
+        self.spans=doc.spans
+        self.advances={}
+        self.hoverTimer.stop()
+        self.hoverSpan=None
+        self.hideTooltip()
+        self.currentLine=doc.currentLine
+        self.updateSize()
+        self.scrollArea.verticalScrollBar().setValue(doc.scrollPosition)
 
     def addHighlight(self,name,line,color,refid):
-        if not line in self.highlights:
-            self.highlights[line]={}
-        hdict=self.highlights.get(line)
-        hdict[name]=(color,refid)
-        
+        self.doc.addHighlight(name,line,color,refid)
+
     def addRefHighlights(self,name,startLine,endLine,color,refid):
-        nameParts=re.findall(identifier,name)
-        name=nameParts[-1]
-        print "Adding ref '{}' between lines {},{}".format(name,startLine,endLine)
-        for line in xrange(startLine,endLine):
-            text=self.text[line-1]
-            parts=re.split(identifier,text)
-            for part in parts:
-                if part==name:
-                    self.addHighlight(part,line,color,refid)
+        name=lastIdentifier(name)
+        log.debug("Adding ref '%s' between lines %d,%d",name,startLine,endLine)
+        if not name is None:
+            self.doc.addHighlights([(name,startLine,endLine,color,refid)])
+
+    def addHighlights(self,highlights):
+        self.doc.addHighlights(highlights)
+
+    def spanAt(self,line,col):
+        return self.doc.spanAt(line,col)
 
     def setCurrentLine(self,path,line):
         """ Set the index (1 based) of the active line
@@ -121,6 +393,42 @@ class CodeView(QtGui.QWidget):
             return ""
         return word
         
+    def lineAdvances(self,lineIndex):
+        """ Returns the cumulative advance widths of a line (0 based)
+
+        Element i is the pixel width of the first i+1 characters.  Built the
+        first time a line is hit tested, and dropped when the text or the
+        font change.
+        
+        """
+        adv=self.advances.get(lineIndex)
+        if adv is None:
+            adv=array('i')
+            x=0
+            for ch in self.text[lineIndex]:
+                w=self.charWidths.get(ch)
+                if w is None:
+                    w=self.fontMetrics.width(ch)
+                    self.charWidths[ch]=w
+                x+=w
+                adv.append(x)
+            self.advances[lineIndex]=adv
+        return adv
+
+    def getMouseColumn(self,lineIndex,x):
+        """ Convert an x pixel position (without the margin) to a column
+
+        Returns -1 if x is past the end of the line.
+        
+        """
+        if x<0:
+            return -1
+        adv=self.lineAdvances(lineIndex)
+        col=bisect_right(adv,x)
+        if col>=len(adv):
+            return -1
+        return col
+
     def getMouseLine(self,event):
         """ Convert mouse event y pixel position to a line number (0 based) """
         y=event.y()
@@ -130,78 +438,87 @@ class CodeView(QtGui.QWidget):
         """ Checks for left click and follow references """
         if event.button()==QtCore.Qt.MouseButton.LeftButton:
             line=self.getMouseLine(event)+1
-            if len(self.wordUnderCursor)>0:
-                hdict=self.highlights.get(line)
-                if self.wordUnderCursor in hdict:
-                    refid=(hdict.get(self.wordUnderCursor))[1]
-                    if not refid is None:
-                        import codebrowser
-                        codebrowser.gBrowser.gotoRef(refid,line)
+            span=self.spanAt(line,self.columnUnderCursor)
+            if not span is None and not span[3] is None:
+                import codebrowser
+                codebrowser.gBrowser.gotoRef(span[3],line)
         super(CodeView,self).mousePressEvent(event)
 
     def mouseMoveEvent(self,event):
         """ Track mouse movements to identify hover events """
-        if self.spacing>0:
-            if self.tipVisible:
-                # Clear old tool tip
-                QtGui.QToolTip.showText(self.hoverPos,"")
-                self.tipVisible=False
-            if event.button()==QtCore.Qt.NoButton and event.type()==QtCore.QEvent.MouseMove:
-                # Simple move.  Reset the counter to wait for hover
-                self.hoverCount=0
-                self.hoverPos=event.pos()
-                
-                
-            # Find column by checking text width incrementally until
-            # it is over the x position (without the margin)                
+        if self.spacing>0 and not self.text is None:
+            # Find column by a binary search of the x position (without the
+            # margin) in the line prefix widths
             x=(event.x()-self.lineNumMargin)
             lineIndex=self.getMouseLine(event)
             self.wordUnderCursor=''
+            self.columnUnderCursor=-1
             if lineIndex<len(self.text) and lineIndex>=0:
-                line=self.text[lineIndex]
-                n=len(line)
-                for i in xrange(1,n):
-                    w=self.fontMetrics.width(line[0:i])
-                    if w>x:
-                        # column position found.  Extract identifier
-                        if line[i-1]!=' ':
-                            self.wordUnderCursor=self.extractWord(line,i-1)
-                        break
+                col=self.getMouseColumn(lineIndex,x)
+                if col>=0:
+                    # column position found.  Extract identifier
+                    self.columnUnderCursor=col
+                    line=self.text[lineIndex]
+                    if line[col]!=' ':
+                        self.wordUnderCursor=self.extractWord(line,col)
+            # (line,span) of the reference under the mouse
+            span=None
+            if self.columnUnderCursor>=0:
+                found=self.spanAt(lineIndex+1,self.columnUnderCursor)
+                if not found is None and not found[3] is None:
+                    span=(lineIndex+1,found)
+            if span!=self.hoverSpan:
+                # Moved to another reference, wait for the mouse to rest on it
+                self.hideTooltip()
+                self.hoverSpan=span
+                self.hoverPos=event.pos()
+                if span is None:
+                    self.hoverTimer.stop()
+                elif event.buttons()==QtCore.Qt.NoButton:
+                    self.hoverTimer.start()
         super(CodeView,self).mouseMoveEvent(event)
 
     def getCurrentWord(self):
         """ Returns the current word calculated during mouse move """
         return self.wordUnderCursor
             
-    def drawHighlights(self,qp,x,y,line,highlights):
-        parts=re.split(identifier,line)
+    def drawHighlights(self,qp,x,y,line,spans):
+        """ Draw a line using its precomputed highlight spans """
         black=QtGui.QColor(0,0,0)
-        fm=qp.fontMetrics()
-        w=fm.boundingRect('a').width()
-        for part in parts:
-            if part in highlights:
-                color=(highlights.get(part))[0]
-                qp.setPen(color)
-            else:
+        w=qp.fontMetrics().width('a')
+        pos=0
+        for col,length,color,refid in spans:
+            if col>pos:
                 qp.setPen(black)
-            qp.drawText(x,y,part)
-            x+=len(part)*w
+                qp.drawText(x+pos*w,y,line[pos:col])
+            qp.setPen(color)
+            qp.drawText(x+col*w,y,line[col:col+length])
+            pos=col+length
+        if pos<len(line):
+            qp.setPen(black)
+            qp.drawText(x+pos*w,y,line[pos:])
             
     def paintEvent(self,event):
         qp=QtGui.QPainter()
         qp.begin(self)
         if not self.text is None:
+            if isinstance(self.text,MappedText):
+                # The lines painted are read from the mapping without checks
+                self.text.check()
             self.draw(qp,event.rect())
         qp.end()
         
     def draw(self,qp,drawRect):
-        """ Draw the source code text, breakpoints and current line mark """
+        """ Draw the source code text, breakpoints and current line mark
+
+        Only the lines intersecting both drawRect and the scroll area
+        viewport are drawn, so the cost does not depend on the file length.
+        
+        """
+        started=instrument.start()
         qp.setFont(self.font)
         fm=qp.fontMetrics()
         self.fm=fm
-        ascent=fm.ascent()
-        descent=fm.descent()
-        self.spacing=fm.lineSpacing()
         # Find the range of visible lines, to find out whether the active
         # line is not visible (and then center it)
         scrollPosition=self.scrollArea.verticalScrollBar().value()
@@ -209,20 +526,25 @@ class CodeView(QtGui.QWidget):
         windowHeight=self.scrollArea.height()
         visibleLines=windowHeight / self.spacing - 1
         lastVisibleLine=firstVisibleLine+visibleLines-1
-        y=self.spacing
-        margin=8 * fm.maxWidth()
-        self.lineNumMargin=0
-        if self.drawLineNumbers:
-            self.lineNumMargin=8*fm.maxWidth()
-            margin+=self.lineNumMargin
-        maxWidth=self.boundingRect.width()
-        boundingHeight=len(self.text)*self.spacing
-        linenum=1
-        # Get the current file breakpoints.  Default to empty
-        for line in self.text:
-            lineRect=fm.boundingRect(line)
-            if lineRect.width() > maxWidth:
-                maxWidth=lineRect.width()
+        # Center around active line, if it is out of the visible range.
+        # Changing the scroll position schedules another paint event.
+        if self.updateScrolling:
+            self.updateScrolling=False
+            if self.currentLine<firstVisibleLine or self.currentLine>lastVisibleLine:
+                newFirst=self.currentLine-visibleLines/2
+                if newFirst<0:
+                    newFirst=0
+                self.scrollArea.verticalScrollBar().setValue(newFirst*self.spacing)
+        # Range of lines (0 based) to paint
+        top=max(drawRect.top(),scrollPosition)
+        bottom=min(drawRect.bottom(),scrollPosition+self.scrollArea.viewport().height())
+        first=max(top/self.spacing,0)
+        last=min(bottom/self.spacing+1,len(self.text)-1)
+        black=QtGui.QColor(0,0,0)
+        y=(first+1)*self.spacing
+        for index in xrange(first,last+1):
+            line=self.text[index]
+            linenum=index+1
             x=0
             # Draw line numbers
             if self.drawLineNumbers:
@@ -230,33 +552,24 @@ class CodeView(QtGui.QWidget):
                 s=' '*(6-len(s))+s
                 qp.drawText(0,y,s)
                 x+=self.lineNumMargin
-            qp.setPen(QtGui.QColor(0,0,0))
+            qp.setPen(black)
             # Draw the actual line text
-            if linenum in self.highlights:
-                self.drawHighlights(qp,x,y,line,self.highlights.get(linenum))
+            if linenum in self.spans:
+                self.drawHighlights(qp,x,y,line,self.spans.get(linenum))
             else:
                 qp.drawText(x,y,line)
-            qp.setPen(QtGui.QColor(0,0,0))
+            qp.setPen(black)
             y+=self.spacing
-            linenum+=1
-        rc=False
-        if boundingHeight>self.boundingRect.height() or maxWidth>self.boundingRect.width():
-            self.boundingRect=QtCore.QRect(0,0,maxWidth,boundingHeight)
-            self.resize(QtCore.QSize(maxWidth+margin,boundingHeight))
-            rc=True
-        # Center around active line, if it is out of the visible range
-        if self.updateScrolling:
-            self.updateScrolling=False
-            if self.currentLine<firstVisibleLine or self.currentLine>lastVisibleLine:
-                newFirst=self.currentLine-visibleLines/2
-                if newFirst<0:
-                    newFirst=0
-                self.scrollArea.verticalScrollBar().setValue(newFirst*self.spacing)
-        return rc
+        instrument.stop('view.paint',started)
+        # Mapped files find longer lines as they are scrolled
+        if len(self.doc.longestLine())>self.longestChars:
+            self.updateSize()
         
     def leaveEvent(self,event):
-        """ Mouse left view, reset the hover counter to infinity """
-        self.hoverCount=100
+        """ Mouse left view, cancel the pending tool tip """
+        self.hoverTimer.stop()
+        self.hoverSpan=None
+        self.hideTooltip()
         super(CodeView,self).leaveEvent(event)
 
     def mouseDoubleClickEvent(self,event):
@@ -268,20 +581,22 @@ class CodeView(QtGui.QWidget):
                 self.toggleBreakpoint(lineIndex)
         super(CodeView,self).mouseDoubleClickEvent(event)
         
-    def onTimer(self):
-        """ Hover detection timer.  Called every 100ms """
-        if self.hoverCount<10:
-            self.hoverCount+=1
-            if self.hoverCount==5:
-                self.generateTooltip()
-            
+    def hideTooltip(self):
+        if self.tipVisible:
+            QtGui.QToolTip.hideText()
+            self.tipVisible=False
+
     def generateTooltip(self):
-        """ Hover above a variable.  Generate an evaluation tooltip """
-        if len(self.wordUnderCursor)>0:
-                tip = '{}'.format('value')
-                pos=self.mapToGlobal(self.hoverPos)
-                QtGui.QToolTip.showText(pos,tip)
-                self.tipVisible=True
+        """ The mouse rests on a reference.  Show what it refers to """
+        if self.hoverSpan is None:
+            return
+        import codebrowser
+        line,span=self.hoverSpan
+        tip=codebrowser.gBrowser.memberTooltip(span[3])
+        if not tip is None:
+            pos=self.mapToGlobal(self.hoverPos)
+            QtGui.QToolTip.showText(pos,tip,self)
+            self.tipVisible=True
 
         
 class CodeEditor(QtGui.QScrollArea):
@@ -301,6 +616,10 @@ class CodeEditor(QtGui.QScrollArea):
         self.code.setText(path,text)
         self.code.repaint()
 
+    def setDocument(self,doc):
+        self.code.setDocument(doc)
+        self.code.repaint()
+
 
 if __name__=='__main__':
     """ Small unit test """
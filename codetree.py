@@ -1,43 +1,524 @@
 from PySide import QtCore
 from PySide import QtGui
-from doxyparse import Reference, Member, Module, readAll
+from doxyparse import Reference, Member, Module
+from cbindex import Index, loadIndex
+from shardindex import Shard, ShardedIndex
+from indexserver import RemoteIndex, IndexServerError
+import os
+import socket
+import logging
+from indexloader import IndexLoader, RefOverlay
 import sys
+from bisect import bisect_right
+
+log=logging.getLogger('codetree')
+
+class CodeTreeModel(QtCore.QAbstractItemModel):
+    """ Item model of the modules and their members
+
+    Only the module rows exist up front.  The member rows of a module are
+    fetched when the module is expanded, and row labels are built when the
+    view asks for them, so no per item objects are kept.
+
+    """
+
+    def __init__(self,parent=None):
+        super(CodeTreeModel,self).__init__(parent)
+        # Internal pointer of the top level (module) indices.  Member
+        # indices point to their module instead.
+        self.root=object()
+        self.modules=[]
+        self.rows={}
+        self.fetched={}
+
+    def setModules(self,modules):
+        self.beginResetModel()
+        self.modules=modules
+        self.rows=dict([(m,i) for i,m in enumerate(modules)])
+        self.fetched={}
+        self.endResetModel()
+
+    def addModules(self,modules):
+        """ Append modules at the end, e.g. while the index is being built """
+        if len(modules)==0:
+            return
+        first=len(self.modules)
+        self.beginInsertRows(QtCore.QModelIndex(),first,first+len(modules)-1)
+        for i,module in enumerate(modules):
+            self.rows[module]=first+i
+        self.modules.extend(modules)
+        self.endInsertRows()
+
+    def replaceModules(self,xmlpaths,modules):
+        """ Remove the modules read from xmlpaths, and insert modules
+
+        The module list must be sorted by source name.  Rows are removed and
+        inserted one by one, so the rest of the tree keeps its state.
+
+        """
+        xmlpaths=set(xmlpaths)
+        for row in reversed([i for i,m in enumerate(self.modules) if m.xmlpath in xmlpaths]):
+            self.beginRemoveRows(QtCore.QModelIndex(),row,row)
+            module=self.modules.pop(row)
+            self.fetched.pop(module,None)
+            self.rows=dict([(m,i) for i,m in enumerate(self.modules)])
+            self.endRemoveRows()
+        for module in modules:
+            row=bisect_right([m.srcname for m in self.modules],module.srcname)
+            self.beginInsertRows(QtCore.QModelIndex(),row,row)
+            self.modules.insert(row,module)
+            self.rows=dict([(m,i) for i,m in enumerate(self.modules)])
+            self.endInsertRows()
+
+    def sortModules(self):
+        """ Sort the modules by source name, keeping the view state """
+        self.layoutAboutToBeChanged.emit()
+        order=sorted(xrange(len(self.modules)),key=lambda i: self.modules[i].srcname)
+        self.modules=[self.modules[i] for i in order]
+        self.rows=dict([(m,i) for i,m in enumerate(self.modules)])
+        # Member indices point to their module, only module rows move
+        old=[index for index in self.persistentIndexList() if index.internalPointer() is self.root]
+        new=[self.createIndex(self.rows.get(self.moduleAt(index)),index.column(),self.root) for index in old]
+        self.changePersistentIndexList(old,new)
+        self.layoutChanged.emit()
+
+    def moduleAt(self,index):
+        """ Returns the module of a module or member index """
+        if not index.isValid():
+            return None
+        ptr=index.internalPointer()
+        if ptr is self.root:
+            return self.modules[index.row()]
+        return ptr
+
+    def memberAt(self,index):
+        """ Returns the member of a member index, None for module indices """
+        if not index.isValid():
+            return None
+        ptr=index.internalPointer()
+        if ptr is self.root:
+            return None
+        return self.fetched.get(ptr)[index.row()]
+
+    def index(self,row,column,parent=QtCore.QModelIndex()):
+        if not self.hasIndex(row,column,parent):
+            return QtCore.QModelIndex()
+        if not parent.isValid():
+            return self.createIndex(row,column,self.root)
+        return self.createIndex(row,column,self.modules[parent.row()])
+
+    def parent(self,index):
+        if not index.isValid():
+            return QtCore.QModelIndex()
+        ptr=index.internalPointer()
+        if ptr is self.root:
+            return QtCore.QModelIndex()
+        return self.createIndex(self.rows.get(ptr),0,self.root)
+
+    def rowCount(self,parent=QtCore.QModelIndex()):
+        if not parent.isValid():
+            return len(self.modules)
+        if parent.internalPointer() is self.root:
+            members=self.fetched.get(self.modules[parent.row()])
+            if not members is None:
+                return len(members)
+        return 0
+
+    def columnCount(self,parent=QtCore.QModelIndex()):
+        return 1
+
+    def hasChildren(self,parent=QtCore.QModelIndex()):
+        if not parent.isValid():
+            return len(self.modules)>0
+        if parent.internalPointer() is self.root:
+            members=self.fetched.get(self.modules[parent.row()])
+            return members is None or len(members)>0
+        return False
+
+    def canFetchMore(self,parent):
+        if parent.isValid() and parent.internalPointer() is self.root:
+            return not self.modules[parent.row()] in self.fetched
+        return False
+
+    def fetchMore(self,parent):
+        module=self.modules[parent.row()]
+        members=module.members
+        if len(members)>0:
+            self.beginInsertRows(parent,0,len(members)-1)
+            self.fetched[module]=members
+            self.endInsertRows()
+        else:
+            self.fetched[module]=members
+
+    def data(self,index,role=QtCore.Qt.DisplayRole):
+        if not index.isValid() or role!=QtCore.Qt.DisplayRole:
+            return None
+        member=self.memberAt(index)
+        if member is None:
+            return self.modules[index.row()].srcname
+        return member.name+member.args
+
+class ShardTreeModel(QtCore.QAbstractItemModel):
+    """ Item model of the shards of a ShardedIndex, their modules and members
+
+    Only the shard rows exist up front.  The modules of a shard are fetched
+    (opening the shard) when it is expanded, and the members of a module
+    when the module is expanded.  Internal pointers are the parent item:
+    the root for shards, the shard for modules and the module for members.
+
+    """
+
+    def __init__(self,parent=None):
+        super(ShardTreeModel,self).__init__(parent)
+        self.root=object()
+        self.shards=[]
+        self.shardRows={}
+        # Fetched modules of each shard and members of each module
+        self.modules={}
+        self.members={}
+        self.moduleRows={}
+
+    def setShards(self,shards):
+        self.beginResetModel()
+        self.shards=shards
+        self.shardRows=dict([(s,i) for i,s in enumerate(shards)])
+        self.modules={}
+        self.members={}
+        self.moduleRows={}
+        self.endResetModel()
+
+    def moduleAt(self,index):
+        """ Returns the module of a module or member index, None for shards """
+        if not index.isValid():
+            return None
+        ptr=index.internalPointer()
+        if ptr is self.root:
+            return None
+        if isinstance(ptr,Shard):
+            return self.modules[ptr][index.row()]
+        return ptr
+
+    def memberAt(self,index):
+        """ Returns the member of a member index, None for other indices """
+        if not index.isValid():
+            return None
+        ptr=index.internalPointer()
+        if ptr is self.root or isinstance(ptr,Shard):
+            return None
+        return self.members[ptr][index.row()]
+
+    def index(self,row,column,parent=QtCore.QModelIndex()):
+        if not self.hasIndex(row,column,parent):
+            return QtCore.QModelIndex()
+        if not parent.isValid():
+            return self.createIndex(row,column,self.root)
+        ptr=parent.internalPointer()
+        if ptr is self.root:
+            return self.createIndex(row,column,self.shards[parent.row()])
+        return self.createIndex(row,column,self.modules[ptr][parent.row()])
+
+    def parent(self,index):
+        if not index.isValid():
+            return QtCore.QModelIndex()
+        ptr=index.internalPointer()
+        if ptr is self.root:
+            return QtCore.QModelIndex()
+        if isinstance(ptr,Shard):
+            return self.createIndex(self.shardRows[ptr],0,self.root)
+        shard,row=self.moduleRows[ptr]
+        return self.createIndex(row,0,shard)
+
+    def children(self,parent):
+        """ Returns the fetched child list of an index, or None """
+        ptr=parent.internalPointer()
+        if ptr is self.root:
+            return self.modules.get(self.shards[parent.row()])
+        if isinstance(ptr,Shard):
+            return self.members.get(self.modules[ptr][parent.row()])
+        return []
+
+    def rowCount(self,parent=QtCore.QModelIndex()):
+        if not parent.isValid():
+            return len(self.shards)
+        children=self.children(parent)
+        if children is None:
+            return 0
+        return len(children)
+
+    def columnCount(self,parent=QtCore.QModelIndex()):
+        return 1
+
+    def hasChildren(self,parent=QtCore.QModelIndex()):
+        if not parent.isValid():
+            return len(self.shards)>0
+        children=self.children(parent)
+        return children is None or len(children)>0
+
+    def canFetchMore(self,parent):
+        return parent.isValid() and self.children(parent) is None
+
+    def fetchMore(self,parent):
+        ptr=parent.internalPointer()
+        if ptr is self.root:
+            shard=self.shards[parent.row()]
+            children=[m for m in shard.open().modules() if len(m.srcname)>0]
+            for i,module in enumerate(children):
+                self.moduleRows[module]=(shard,i)
+            fetched=self.modules
+            key=shard
+        else:
+            key=self.modules[ptr][parent.row()]
+            children=key.members
+            fetched=self.members
+        if len(children)>0:
+            self.beginInsertRows(parent,0,len(children)-1)
+            fetched[key]=children
+            self.endInsertRows()
+        else:
+            fetched[key]=children
+
+    def data(self,index,role=QtCore.Qt.DisplayRole):
+        if not index.isValid() or role!=QtCore.Qt.DisplayRole:
+            return None
+        ptr=index.internalPointer()
+        if ptr is self.root:
+            return self.shards[index.row()].name
+        if isinstance(ptr,Shard):
+            return self.modules[ptr][index.row()].srcname
+        member=self.members[ptr][index.row()]
+        return member.name+member.args
+
+# Larger updates reload the whole tree instead of patching it row by row
+MAX_PATCHED_FILES=200
 
 class CodeTree(QtGui.QDockWidget):
     def __init__(self,parent=None):
         super(CodeTree,self).__init__(parent)
-        self.tree=QtGui.QTreeWidget()
+        self.tree=QtGui.QTreeView()
+        self.tree.setUniformRowHeights(True)
+        self.model=CodeTreeModel(self.tree)
+        self.tree.setModel(self.model)
         self.setWidget(self.tree)
-        self.tree.itemDoubleClicked.connect(self.onDoubleClick)
+        self.tree.doubleClicked.connect(self.onDoubleClick)
         self.references={}
         self.modules={}
-        
-    def loadCodeTree(self):
-        all=readAll()
+        self.index=None
+        self.loader=None
+        self.streamed=False
+        self.backend='index'
+        self.loadArgs=(1,None,None)
+        self.updatePending=False
+
+    def loadCodeTree(self,workers=1,include=None,exclude=None):
+        self.index=loadIndex(workers=workers,include=include,exclude=exclude)
+        from codebrowser import setReferences
+        setReferences(self.index)
+        self.showIndexModules()
+
+    def showIndexModules(self):
+        all=[m for m in self.index.modules() if len(m.srcname)>0]
+        self.modules={}
         for module in all:
-            if len(module.srcname)>0:
-                item=QtGui.QTreeWidgetItem([module.srcname])
-                from codebrowser import moduleDoubleClick
-                item.onDoubleClick=moduleDoubleClick
-                item.module=module
-                self.modules[module.srcpath]=module
-                self.tree.addTopLevelItem(item)
-                self.addMembers(item,module)
-        del all
-    
-    def getModule(self,path):
-        return self.modules.get(path)
+            self.modules[module.srcpath]=module
+        self.model.setModules(all)
+
+    def openBackend(self,sharded=False,server=None):
+        """ Open the index, returns the backend name used by the loader
+
+        'server' is an index server at the server socket, 'shards' a
+        ShardedIndex and 'index' the cb.db Index.  When no server answers,
+        the index is read in process.
+
+        """
+        if not server is None:
+            try:
+                self.index=RemoteIndex(server)
+                return 'server'
+            except (socket.error,IndexServerError),e:
+                log.warning('No index server on %s (%s), reading the index in process',server,e)
+        if sharded:
+            self.index=ShardedIndex()
+            return 'shards'
+        self.index=Index()
+        return 'index'
+
+    def startLoading(self,workers=1,include=None,exclude=None,sharded=False,server=None):
+        """ Show the indexed modules, and update the index in the background
+
+        When the index is new, modules are added to the tree as they are
+        parsed, and can be browsed right away.  Otherwise the tree shows
+        the index contents, and the modules changed by the update are
+        replaced.  A sharded index shows one row per shard, whose modules
+        are read when it is expanded.  With an index server, the server
+        does the update.
+        
+        """
+        self.loadArgs=(workers,include,exclude)
+        self.backend=self.openBackend(sharded,server)
+        from codebrowser import setReferences
+        if self.backend=='shards':
+            self.streamed=False
+            setReferences(self.index)
+            self.model=ShardTreeModel(self.tree)
+            self.tree.setModel(self.model)
+            self.model.setShards(self.index.shardList())
+            self.startLoader()
+            return
+        self.streamed=self.backend=='index' and self.index.isEmpty()
+        if self.streamed:
+            setReferences(RefOverlay(self.index))
+            self.model.setModules([])
+        else:
+            setReferences(self.index)
+            self.showIndexModules()
+        self.startLoader()
+
+    def updateIndex(self):
+        """ Bring the index up to date in the background, e.g. after doxygen ran """
+        if self.index is None:
+            return
+        if self.isLoading():
+            self.updatePending=True
+        else:
+            self.startLoader()
+
+    def startLoader(self):
+        workers,include,exclude=self.loadArgs
+        path=self.index.path
+        if self.backend=='shards':
+            path=self.index.dir
+        self.loader=IndexLoader(path,workers,include,exclude,self.backend,self)
+        if self.backend=='server':
+            self.loader.generation=self.index.generation
+        if self.streamed:
+            self.loader.modulesParsed.connect(self.onModulesParsed)
+        self.loader.progress.connect(self.onProgress)
+        self.loader.indexReady.connect(self.onIndexReady)
+        self.loader.failed.connect(self.onLoadFailed)
+        self.loader.start()
+
+    def isLoading(self):
+        return not self.loader is None
+
+    def stopLoading(self):
+        """ Cancel the background update, e.g. when the browser is closed """
+        if not self.loader is None:
+            self.loader.cancel()
+            self.loader.wait()
+            self.loader=None
+
+    def onModulesParsed(self,modules):
+        modules=[m for m in modules if len(m.srcname)>0]
+        for module in modules:
+            self.modules[module.srcpath]=module
+        from codebrowser import gBrowser
+        gBrowser.refs.addModules(modules)
+        self.model.addModules(modules)
+
+    def onProgress(self,parsed,found):
+        from codebrowser import gBrowser
+        gBrowser.indexProgress(parsed,found)
+
+    def onIndexReady(self,changed):
+        if self.backend=='server':
+            self.index.generation=self.loader.generation
+        self.loader=None
+        from codebrowser import gBrowser, setReferences
+        if self.streamed:
+            self.streamed=False
+            self.index.reset()
+            setReferences(self.index)
+            indexed=len([m for m in self.index.modules() if len(m.srcname)>0])
+            if indexed==len(self.model.modules):
+                # Keep the parsed modules, they are already shown and loaded
+                self.model.sortModules()
+            else:
+                self.showIndexModules()
+            paths=None
+        elif changed is None:
+            # The server no longer knows what changed since the last update
+            self.index.reset()
+            self.showIndexModules()
+            paths=None
+        elif self.backend=='shards':
+            paths=self.applyShardChanges(changed)
+        else:
+            paths=self.applyChanges(changed)
+        gBrowser.indexReady(paths)
+        if self.updatePending:
+            self.updatePending=False
+            self.startLoader()
+
+    def xmlDirs(self):
+        """ Returns the directories of the indexed XML files """
+        return self.index.xmlDirs()
+
+    def applyChanges(self,xmlpaths):
+        """ Patch the tree with the modules of XML files changed in the index
+
+        Returns the source paths of the modules that changed.
+        
+        """
+        if len(xmlpaths)==0:
+            return set()
+        removed,added=self.index.refresh(xmlpaths)
+        xmlpaths=set(xmlpaths)
+        # The tree may hold modules parsed before the index was written
+        old=[m for m in self.model.modules if m.xmlpath in xmlpaths]
+        paths=set([m.srcpath for m in removed+added+old])
+        if len(xmlpaths)>MAX_PATCHED_FILES:
+            self.showIndexModules()
+            return paths
+        added=[m for m in added if len(m.srcname)>0]
+        self.model.replaceModules(xmlpaths,added)
+        for module in old:
+            if self.modules.get(module.srcpath) is module:
+                del self.modules[module.srcpath]
+        for module in added:
+            self.modules[module.srcpath]=module
+        return paths
+
+    def applyShardChanges(self,xmlpaths):
+        """ Show the shards again after an update of a sharded index
+
+        Returns the source paths of the modules that changed in the shards
+        opened so far, the others have never been shown.
         
-    def addMembers(self,item,module):
-        for member in module.members:
-            from codebrowser import addReference
-            addReference(member.id,member)
-            text=member.name+member.args
-            memberItem=QtGui.QTreeWidgetItem([text])
-            from codebrowser import memberDoubleClick
-            memberItem.onDoubleClick=memberDoubleClick
-            memberItem.member=member
-            item.addChild(memberItem)
-            
-    def onDoubleClick(self,item, column):
-        item.onDoubleClick(item)
+        """
+        if len(xmlpaths)==0:
+            return set()
+        removed,added=self.index.refresh(xmlpaths)
+        self.model.setShards(self.index.shardList())
+        return set([m.srcpath for m in removed+added])
+
+    def onLoadFailed(self,message):
+        self.loader=None
+        from codebrowser import gBrowser
+        gBrowser.indexFailed(message)
+
+    def sourcePaths(self):
+        """ Returns the source files of all indexed modules
+
+        Returns None for a sharded index, whose shards are not all open, see
+        shardindex.sourcePaths.
+
+        """
+        if self.backend=='shards':
+            return None
+        return set(self.modules.keys())
+
+    def getModule(self,path,openShards=False):
+        if self.backend=='shards':
+            return self.index.moduleForPath(path,openShards)
+        return self.modules.get(path)
+
+    def onDoubleClick(self,index):
+        from codebrowser import moduleDoubleClick, memberDoubleClick
+        member=self.model.memberAt(index)
+        if member is None:
+            module=self.model.moduleAt(index)
+            # Shard rows only expand
+            if not module is None:
+                moduleDoubleClick(module)
+        else:
+            memberDoubleClick(member)
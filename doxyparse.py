@@ -2,24 +2,186 @@
 import os
 import sys
 import re
-import xml.etree.ElementTree as ET
-
-def scanXMLDirs(base):
-    dirs=[]
+import hashlib
+import logging
+import fnmatch
+import threading
+import Queue
+import itertools
+import multiprocessing
+from array import array
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+try:
+    from os import scandir
+except ImportError:
     try:
-        names=os.listdir(base)
-        if 'xml' in names:
-            dirs.append(os.path.join(base,'xml'))
+        from scandir import scandir
+    except ImportError:
+        scandir=None
+import instrument
+
+log=logging.getLogger('doxyparse')
+
+# Directories that never hold doxygen output, and are not searched
+SKIP_DIRS=set(['.git','.hg','.svn','CVS','node_modules','__pycache__',
+               '.tox','.nox','.venv','.mypy_cache','.pytest_cache','.idea'])
+
+def listSubdirs(path):
+    """ Returns the names of the subdirectories of path (following symlinks) """
+    if scandir is None:
+        return [name for name in os.listdir(path) if os.path.isdir(os.path.join(path,name))]
+    subdirs=[]
+    for entry in scandir(path):
+        try:
+            if entry.is_dir():
+                subdirs.append(entry.name)
+        except OSError:
+            pass
+    return subdirs
+
+def matches(relpath,patterns):
+    """ Check a directory against fnmatch patterns, by relative path or name """
+    name=os.path.basename(relpath)
+    for pattern in patterns:
+        if fnmatch.fnmatch(relpath,pattern) or fnmatch.fnmatch(name,pattern):
+            return True
+    return False
+
+class DirWalker:
+    """ Iterative search for doxygen 'xml' directories
+
+    Directories in SKIP_DIRS or matching one of the exclude patterns are
+    pruned.  If include patterns are given, only xml directories matching
+    one of them are reported.  Every directory is visited once, by device
+    and inode, so symlink loops are harmless.
+
+    """
+    
+    def __init__(self,base,include=None,exclude=None):
+        self.base=base
+        self.include=include or []
+        self.exclude=exclude or []
+        self.visited=set()
+        self.lock=threading.Lock()
+
+    def visit(self,path):
+        """ Returns the xml directory of path (or None), and the subdirectories to visit """
+        try:
+            st=os.stat(path)
+            key=(st.st_dev,st.st_ino)
+            with self.lock:
+                if key in self.visited:
+                    return None,[]
+                self.visited.add(key)
+            names=listSubdirs(path)
+        except OSError:
+            return None,[]
+        xmlDir=None
+        subdirs=[]
         for name in names:
-            dirs=dirs+scanXMLDirs(os.path.join(base,name))
-    except OSError:
-        pass
-    return dirs
-
-class Reference:
-    def __init__(self,root):
-        self.refid=root.get('refid')
-        self.ident=root.text
+            if name in SKIP_DIRS:
+                continue
+            subpath=os.path.join(path,name)
+            relpath=os.path.relpath(subpath,self.base)
+            if len(self.exclude)>0 and matches(relpath,self.exclude):
+                continue
+            if name=='xml' and (len(self.include)==0 or matches(relpath,self.include)):
+                xmlDir=subpath
+            subdirs.append(subpath)
+        return xmlDir,subdirs
+
+    def walk(self):
+        """ Yields xml directories depth first, as they are found """
+        pending=[self.base]
+        while len(pending)>0:
+            xmlDir,subdirs=self.visit(pending.pop())
+            if not xmlDir is None:
+                yield xmlDir
+            subdirs.reverse()
+            pending.extend(subdirs)
+
+    def walkParallel(self,threads):
+        """ Yields xml directories as they are found by a pool of threads """
+        work=Queue.Queue()
+        found=Queue.Queue()
+        done=object()
+        # Number of directories queued or being visited
+        pending=[1]
+        stopped=[]
+        def worker():
+            while True:
+                path=work.get()
+                if path is None:
+                    return
+                if len(stopped)>0:
+                    continue
+                xmlDir,subdirs=self.visit(path)
+                # Reported before the subdirectories are queued, as visiting
+                # them may finish the walk
+                if not xmlDir is None:
+                    found.put(xmlDir)
+                with self.lock:
+                    pending[0]+=len(subdirs)-1
+                    finished=pending[0]==0
+                for subdir in subdirs:
+                    work.put(subdir)
+                if finished:
+                    found.put(done)
+        pool=[threading.Thread(target=worker) for i in xrange(threads)]
+        for t in pool:
+            t.daemon=True
+            t.start()
+        work.put(self.base)
+        try:
+            while True:
+                xmlDir=found.get()
+                if xmlDir is done:
+                    break
+                yield xmlDir
+        finally:
+            stopped.append(True)
+            for t in pool:
+                work.put(None)
+            for t in pool:
+                t.join()
+
+def walkXMLDirs(base,include=None,exclude=None,threads=1):
+    """ Yields the doxygen xml directories under base as a stream
+
+    Consumers can start reading the first directories while the search
+    goes on.  With threads>1 directories are listed by a pool of threads,
+    and are reported in no particular order.
+    
+    """
+    walker=DirWalker(base,include,exclude)
+    if threads>1:
+        return walker.walkParallel(threads)
+    return walker.walk()
+
+def scanXMLDirs(base):
+    return list(walkXMLDirs(base))
+
+def internString(s):
+    """ Returns the shared copy of s, so equal ids and paths are stored once """
+    if type(s) is str:
+        return intern(s)
+    return s
+
+class Reference(object):
+    __slots__=('refid','ident')
+
+    def __init__(self,root=None):
+        if not root is None:
+            self.refid=internString(root.get('refid'))
+            self.ident=internString(root.text)
+            
+    def assign(self,refid,ident):
+        self.refid=refid
+        self.ident=ident
+        return self
         
     def save(self):
         root=ET.Element('reference')
@@ -27,47 +189,69 @@ class Reference:
         root.text=self.ident
         return root
 
-class Member:
-    def __init__(self,module,root):
+class Member(object):
+    """ A function, variable or define of a module
+
+    Members are kept small, as there are millions of them in large trees:
+    attributes are slots, strings are interned, and the line numbers and
+    references are stored in arrays of the module (see Module.addMemberData).
+    refs builds the Reference objects when it is read.
+
+    """
+    __slots__=('module','row','id','name','args','filepath')
+
+    def __init__(self,module,root=None):
         self.module=module
+        if root is None:
+            return
         if root.tag=="memberdef":
             self.loadFromXMLFile(root)
         elif root.tag=="member":
             self.load(root)
         elif root.tag=="codeline":
-            print "Loading codeline"
+            log.debug("Loading codeline")
+
+    @property
+    def line(self):
+        return self.module.lines[self.row]
+
+    @property
+    def bodyend(self):
+        return self.module.bodyends[self.row]
+
+    @property
+    def refs(self):
+        module=self.module
+        start=module.refStarts[self.row]
+        return [Reference().assign(module.refids[i],module.idents[i])
+                for i in xrange(start,start+module.refCounts[self.row])]
         
-    def assign(self,id,name,line):
-        self.id=id
-        self.name=name
-        self.args=''
-        self.filepath=self.module.srcpath
-        self.line=line
-        self.bodyend=line+1
-        self.refs=[]
+    def assign(self,id,name,line,args='',filepath=None,bodyend=None,refs=()):
+        """ Set the member fields, refs is a sequence of (refid,ident) """
+        self.id=internString(id)
+        self.name=internString(name)
+        self.args=internString(args)
+        if filepath is None:
+            filepath=self.module.srcpath
+        self.filepath=internString(filepath)
+        if bodyend is None:
+            bodyend=line+1
+        self.row=self.module.addMemberData(line,bodyend,refs)
         
     def loadFromXMLFile(self,root):
-        self.id=root.get('id')
-        self.name=root.find('name').text
-        self.args=root.find('argsstring')
-        if not self.args is None:
-            self.args=self.args.text
-        if self.args is None:
-            self.args=''
+        args=root.find('argsstring')
+        if not args is None:
+            args=args.text
+        if args is None:
+            args=''
         loc=root.find('location')
-        self.filepath=loc.get('file')
-        self.line=int(loc.get('line'))
+        line=int(loc.get('line'))
         try:
-            self.bodyend=int(loc.get('bodyend'))
+            bodyend=int(loc.get('bodyend'))
         except Exception:
-            self.bodyend=self.line+1
-        self.refs=[]
-        allrefs=root.findall('references')
-        self.readRefs(allrefs)
-        
-    def readRefs(self,refs):
-        for ref in refs:
-            self.refs.append(Reference(ref))
+            bodyend=line+1
+        refs=[(ref.get('refid'),ref.text) for ref in root.findall('references')]
+        self.assign(root.get('id'),root.find('name').text,line,args,loc.get('file'),bodyend,refs)
             
     def save(self):
         root=ET.Element('member')
@@ -82,16 +266,9 @@ class Member:
         return root
         
     def load(self,root):
-        self.refs=[]
-        self.id=root.get('id')
-        self.name=root.get('name')
-        self.args=root.get('args')
-        self.filepath=root.get('filepath')
-        self.line=int(root.get('line'))
-        self.bodyend=int(root.get('bodyend'))
-        allrefs=root.findall('reference')
-        for r in allrefs:
-            self.refs.append(Reference(r))
+        refs=[(r.get('refid'),r.text) for r in root.findall('reference')]
+        self.assign(root.get('id'),root.get('name'),int(root.get('line')),root.get('args'),
+                    root.get('filepath'),int(root.get('bodyend')),refs)
             
         
 
@@ -103,48 +280,168 @@ class Module:
             self.load(src)
             
     def loadFromXMLFile(self,filepath):
-        print "Loading {}".format(filepath)
+        """ Read a compound XML file incrementally
+
+        The file is streamed with iterparse.  Every memberdef and codeline
+        is handled as soon as it is complete, and elements are dropped from
+        the partial tree right after they are read, so memory stays flat no
+        matter how long the program listing is.
+        
+        """
+        log.debug("Loading %s",filepath)
+        self.xmlpath=filepath
         self.srcpath=""
         self.srcname=""
-        tree=ET.parse(filepath)
-        root=tree.getroot()
-        root=root.find('compounddef')
-        if root is None:
-            raise Exception('File has no compoundDef')
-        self.id=root.get('id')
+        self.id=None
         self.members=[]
-        try:
-            allsec=root.findall('sectiondef')
-            for sec in allsec:
-                kind=sec.get('kind')
-                if kind=='var' or kind=='func' or kind=='define':
-                    self.readSection(sec)
-        except Exception,e:
-            print "Exception reading sections for module {}\n{}".format(filepath,e)
-        listing=root.find('programlisting')
-        if not listing is None:
-            self.loadCodeLines(listing)
+        self.initMemberData()
+        self.initSpans()
+        codeMembers=[]
+        # Stack of currently open elements, used to check the context of
+        # each element and to detach it from its parent when done
+        stack=[]
+        # Number of open memberdef/codeline elements, whose subtree is still needed
+        keep=0
+        for event,elem in ET.iterparse(filepath,events=('start','end')):
+            tag=elem.tag
+            if event=='start':
+                if tag=='compounddef' and len(stack)==1 and self.id is None:
+                    self.id=elem.get('id')
+                elif tag=='memberdef' or tag=='codeline':
+                    keep+=1
+                stack.append(elem)
+                continue
+            stack.pop()
+            if tag=='memberdef' or tag=='codeline':
+                keep-=1
+                if self.inSection(stack):
+                    if tag=='memberdef':
+                        self.readMember(filepath,elem)
+                    else:
+                        self.loadCodeLine(elem,codeMembers)
+            if keep==0 and len(stack)>0:
+                elem.clear()
+                stack[-1].remove(elem)
+        if self.id is None:
+            raise Exception('File has no compoundDef')
+        self.members.extend(codeMembers)
         self.srcpath=self.members[0].filepath
         self.srcname=(self.srcpath.split('/'))[-1]
+
+    def inSection(self,stack):
+        """ Check the context of a memberdef or codeline being streamed
+
+        Only members of var/func/define sections, and code lines of the
+        compound program listing are read.
+        
+        """
+        if len(stack)!=3 or stack[1].tag!='compounddef' or stack[1].get('id')!=self.id:
+            return False
+        parent=stack[2]
+        if parent.tag=='sectiondef':
+            kind=parent.get('kind')
+            return kind=='var' or kind=='func' or kind=='define'
+        return parent.tag=='programlisting'
+        
+    def readMember(self,filepath,root):
+        try:
+            self.members.append(Member(self,root))
+        except Exception,e:
+            log.warning("Exception reading sections for module %s: %s",filepath,e)
         
     def loadCodeLines(self,listing):
-        codelines=listing.findall('codeline')
-        for cl in codelines:
-            refid=cl.get('refid')
-            if not refid is None:
-                line=int(cl.get('lineno'))
-                for r in cl.iter('ref'):
-                    if r.get('refid')==refid:
-                        m=Member(self,ET.Element('stub'))
-                        m.assign(refid,r.text,line)
-                        self.members.append(m)
-                        
+        codeMembers=[]
+        for cl in listing.findall('codeline'):
+            self.loadCodeLine(cl,codeMembers)
+        self.members.extend(codeMembers)
+
+    def loadCodeLine(self,cl,codeMembers):
+        refid=cl.get('refid')
+        line=int(cl.get('lineno'))
+        if not refid is None:
+            for r in cl.iter('ref'):
+                if r.get('refid')==refid:
+                    m=Member(self)
+                    m.assign(refid,r.text,line)
+                    codeMembers.append(m)
+        self.readSpans(cl,line,0)
+
+    def readSpans(self,elem,line,col):
+        """ Record the refs of a program listing element as code spans
+
+        Columns are counted through the highlight text, each <sp/> being
+        one space.  Returns the column after the element content.
+        
+        """
+        if not elem.text is None:
+            col+=len(elem.text)
+        for child in elem:
+            tag=child.tag
+            if tag=='sp':
+                col+=1
+            elif tag=='ref':
+                ident=child.text or ''
+                self.addSpan(line,col,child.get('refid'),ident)
+                col+=len(ident)
+            else:
+                col=self.readSpans(child,line,col)
+            if not child.tail is None:
+                col+=len(child.tail)
+        return col
 
     def readSection(self,sec):
         all=sec.findall('memberdef')
         for member in all:
             self.members.append(Member(self,member))
             
+    def initMemberData(self):
+        """ Create the arrays holding the lines and references of the members """
+        self.lines=array('i')
+        self.bodyends=array('i')
+        self.refStarts=array('i')
+        self.refCounts=array('i')
+        self.refids=[]
+        self.idents=[]
+
+    def addMemberData(self,line,bodyend,refs):
+        """ Store the lines and (refid,ident) references of a new member
+
+        Returns the row of the member in the arrays.
+        
+        """
+        row=len(self.lines)
+        self.lines.append(line)
+        self.bodyends.append(bodyend)
+        start=len(self.refids)
+        self.refStarts.append(start)
+        for refid,ident in refs:
+            self.refids.append(internString(refid))
+            self.idents.append(internString(ident))
+        self.refCounts.append(len(self.refids)-start)
+        return row
+
+    def initSpans(self):
+        """ Create the arrays holding the code spans of the program listing """
+        self.spanLines=array('i')
+        self.spanCols=array('i')
+        self.spanRefids=[]
+        self.spanIdents=[]
+
+    def addSpan(self,line,col,refid,ident):
+        """ Record a reference to refid, spelled ident, at a line (1 based) and column """
+        self.spanLines.append(line)
+        self.spanCols.append(col)
+        self.spanRefids.append(internString(refid))
+        self.spanIdents.append(internString(ident))
+
+    def codeSpans(self):
+        """ Returns the (line,col,refid,ident) references of the program listing
+
+        Empty if doxygen did not write a listing (SOURCE_BROWSER=NO).
+        
+        """
+        return zip(self.spanLines,self.spanCols,self.spanRefids,self.spanIdents)
+
     def sort(self):
         self.members.sort(key=lambda member: member.name)
             
@@ -153,69 +450,250 @@ class Module:
         root.set('id',self.id)
         root.set('srcpath',self.srcpath)
         root.set('srcname',self.srcname)
+        if not self.xmlpath is None:
+            root.set('xmlpath',self.xmlpath)
         for member in self.members:
             root.append(member.save())
+        for line,col,refid,ident in self.codeSpans():
+            e=ET.SubElement(root,'span')
+            e.set('line',str(line))
+            e.set('col',str(col))
+            e.set('refid',refid)
+            e.text=ident
         return root
         
     def load(self,root):
         self.id=root.get('id')
         self.srcpath=root.get('srcpath')
         self.srcname=root.get('srcname')
+        self.xmlpath=root.get('xmlpath')
         self.members=[]
+        self.initMemberData()
+        self.initSpans()
         members=root.findall('member')
         for m in members:
             self.members.append(Member(self,m))
+        for e in root.findall('span'):
+            self.addSpan(int(e.get('line')),int(e.get('col')),e.get('refid'),e.text or '')
         
-def readXMLDirs(dirs):
-    modules=[]
+def listXMLFiles(dirs):
+    """ Yields the paths of all compound XML files in the given directories """
     for dir in dirs:
         files=os.listdir(dir)
         #files=files[0:25]
         for filename in files:
             if filename.endswith('.xml'):
-                try:
-                    filepath=os.path.join(dir,filename)
-                    modules.append(Module(filepath))
-                except Exception:
-                    pass
-    return modules
+                yield os.path.join(dir,filename)
+
+def parseXMLFile(filepath):
+    """ Build a Module from a compound XML file
+
+    Returns None for files that cannot be read as a compound, so that the
+    serial and the parallel readers skip exactly the same files.  This is
+    a module level function so it can be handed to a process pool.
+    
+    """
+    try:
+        return Module(filepath)
+    except Exception:
+        return None
+
+def iterXMLFiles(files,workers=1):
+    """ Parse a sequence of compound XML files
+
+    Yields one entry per file, as soon as it is parsed: the Module, or None
+    if the file is not a valid compound.  With workers>1 the files are
+    spread over a pool of worker processes.  A value below 1 uses one worker
+    per CPU.  Results are merged in file order, so the output is identical
+    to the serial path.
+    
+    """
+    if workers<1:
+        workers=multiprocessing.cpu_count()
+    files=iter(files)
+    if workers>1:
+        # Start the pool only if there is something to parse
+        try:
+            first=next(files)
+        except StopIteration:
+            return
+        files=itertools.chain([first],files)
+    if workers==1:
+        for filepath in files:
+            module=parseXMLFile(filepath)
+            instrument.count('ingest.files')
+            yield module
+        return
+    pool=multiprocessing.Pool(workers)
+    finished=False
+    try:
+        for module in pool.imap(parseXMLFile,files,16):
+            instrument.count('ingest.files')
+            yield module
+        finished=True
+    finally:
+        # Stopped early: drop the files still queued
+        if finished:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
+
+def readXMLFiles(files,workers=1):
+    """ Parse a sequence of compound XML files, returns the list of results """
+    with instrument.timed('ingest.parse'):
+        results=list(iterXMLFiles(files,workers))
+    instrument.count('ingest.invalid',len([m for m in results if m is None]))
+    return results
+
+def readXMLDirs(dirs,workers=1):
+    """ Parse all compound XML files found in dirs """
+    results=readXMLFiles(listXMLFiles(dirs),workers)
+    return [m for m in results if not m is None]
+
+def hashFile(filepath):
+    h=hashlib.sha1()
+    f=open(filepath,'rb')
+    try:
+        while True:
+            block=f.read(1<<16)
+            if not block:
+                break
+            h.update(block)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+def fileSignature(filepath,old=None):
+    """ Returns the (mtime,size,hash) signature of an XML file
+
+    If the modification time and size match the old signature, the file
+    is assumed unchanged and the old hash is reused without reading it.
     
-def save(modules):
+    """
+    st=os.stat(filepath)
+    if not old is None and old[0]==st.st_mtime and old[1]==st.st_size:
+        return old
+    return (st.st_mtime,st.st_size,hashFile(filepath))
+
+def checkSources(sources,files):
+    """ Compare cached XML file signatures with the files on disk
+
+    sources maps each XML file to its cached (mtime,size,hash) signature,
+    files yields the XML files currently found.  Yields (filepath,sig,stale)
+    for each readable file, where sig is its current signature and stale
+    tells whether it was added or its content hash changed, so it must be
+    parsed.
+    
+    """
+    for filepath in files:
+        old=sources.get(filepath)
+        try:
+            sig=fileSignature(filepath,old)
+        except (IOError,OSError):
+            continue
+        yield filepath,sig,old is None or old[1:]!=sig[1:]
+
+def save(modules,sources=None):
     root=ET.Element('modules')
+    if not sources is None:
+        srcs=ET.SubElement(root,'sources')
+        for filepath in sorted(sources):
+            mtime,size,h=sources.get(filepath)
+            e=ET.SubElement(srcs,'source')
+            e.set('path',filepath)
+            e.set('mtime',repr(mtime))
+            e.set('size',str(size))
+            e.set('hash',h)
     for m in modules:
         root.append(m.save())
     return root
     
-def load():
+def loadCache(path='cb.xml'):
+    """ Read a cb.xml cache
+
+    Returns (modules,sources), or None if there is no cache.  sources maps
+    each XML file to its (mtime,size,hash) signature, and is empty for
+    caches written before signatures were recorded.
+    
+    """
     try:
-        root=ET.parse('cb.xml')
-        print 'Loading from cb.xml'
+        root=ET.parse(path)
+        log.info('Loading from %s',path)
         modules=[]
         allmods=root.findall('module')
         for m in allmods:
             modules.append(Module(m))
-        return modules
+        sources={}
+        for e in root.findall('sources/source'):
+            sources[e.get('path')]=(float(e.get('mtime')),int(e.get('size')),e.get('hash'))
+        return modules,sources
     except IOError:
         return None
 
+def load():
+    cache=loadCache()
+    if cache is None:
+        return None
+    return cache[0]
+
 def sortAll(all):
     all.sort(key=lambda m: m.srcname)
     for m in all:
         m.sort()
 
 
-def readAll():
-    all=load()
-    if all is None:
-        dirs=scanXMLDirs('.')
-        all=readXMLDirs(dirs)
-        print 'Writing to cb.xml'
-        ET.ElementTree(save(all)).write('cb.xml')
-    sortAll(all)
+def readAll(workers=1,include=None,exclude=None):
+    """ Returns all modules, sorted and with their members loaded
+
+    The modules come from the index (see cbindex), which is brought up to
+    date with the XML files first.
+    
+    """
+    import cbindex
+    index=cbindex.loadIndex(workers=workers,include=include,exclude=exclude)
+    all=index.modules()
+    for m in all:
+        m.members
     return all
 
+def parseArgs(argv):
+    """ Parse the command line options shared by all entry points
+
+    Unknown options are returned untouched, so they can be passed on
+    (e.g. to the Qt application object).
+    
+    """
+    import argparse
+    parser=argparse.ArgumentParser()
+    parser.add_argument('-j','--jobs',type=int,default=1,
+                        help='number of processes used to parse the XML files (0 for one per CPU)')
+    parser.add_argument('--include',action='append',default=[],metavar='PATTERN',
+                        help='only read xml directories matching PATTERN (may be repeated)')
+    parser.add_argument('--exclude',action='append',default=[],metavar='PATTERN',
+                        help='do not search directories matching PATTERN (may be repeated)')
+    parser.add_argument('--shards',action='store_true',
+                        help='keep one index per xml directory in cb.shards, loaded when browsed')
+    parser.add_argument('--server',nargs='?',const='cb.sock',default=None,metavar='SOCKET',
+                        help='use the index server listening on SOCKET (default cb.sock), see indexserver.py')
+    parser.add_argument('--cache-mb',type=int,default=64,
+                        help='memory limit of the cache of prepared source files, in MB')
+    parser.add_argument('--log-level',default='warning',choices=['debug','info','warning','error'],
+                        help='level of the messages written to stderr')
+    parser.add_argument('--stats',action='store_true',
+                        help='collect timers and counters, and write them to stderr at exit')
+    return parser.parse_known_args(argv)
+
+def setupArgs(args):
+    """ Apply the logging and instrumentation options """
+    instrument.setupLogging(args.log_level)
+    if args.stats:
+        instrument.enable()
+
 def main():
-    readAll()
+    args,rest=parseArgs(sys.argv[1:])
+    setupArgs(args)
+    readAll(args.jobs,args.include,args.exclude)
     
 if __name__=="__main__":
     main()
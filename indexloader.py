@@ -0,0 +1,155 @@
+from PySide import QtCore
+import time
+import socket
+import logging
+import cbindex
+import shardindex
+import indexserver
+
+log=logging.getLogger('indexloader')
+
+# Longest time parsed modules are held back before being shown
+BATCH_SECONDS=0.2
+
+class Cancelled(Exception):
+    pass
+
+class IndexLoader(QtCore.QThread):
+    """ Brings the index up to date on a worker thread
+
+    The thread has its own connection to the index database.  Modules are
+    handed to the user interface in batches as they are parsed, so they can
+    be browsed before the whole index is written.
+
+    """
+    modulesParsed=QtCore.Signal(object)
+    progress=QtCore.Signal(int,int)
+    # XML files whose modules changed
+    indexReady=QtCore.Signal(object)
+    failed=QtCore.Signal(str)
+
+    def __init__(self,path,workers=1,include=None,exclude=None,backend='index',parent=None):
+        super(IndexLoader,self).__init__(parent)
+        self.path=path
+        # 'index', 'shards' or 'server', see CodeTree.openBackend
+        self.backend=backend
+        # Index generation of the server backend, before and after the update
+        self.generation=None
+        self.workers=workers
+        self.include=include
+        self.exclude=exclude
+        self.cancelled=False
+        # Server connection of the thread, see refreshRemote
+        self.remote=None
+        self.batch=[]
+        self.lastBatch=0
+
+    def cancel(self):
+        """ Ask the thread to stop, the index is left unchanged """
+        self.cancelled=True
+        remote=self.remote
+        if not remote is None:
+            remote.abort()
+
+    def openIndex(self):
+        """ Returns the index connection of the thread, and its refresh function """
+        if self.backend=='shards':
+            return shardindex.ShardedIndex(self.path),shardindex.refreshShards
+        if self.backend=='server':
+            return indexserver.RemoteIndex(self.path,self.generation),self.refreshRemote
+        return cbindex.Index(self.path),cbindex.refreshIndex
+
+    def run(self):
+        self.lastBatch=time.time()
+        try:
+            index,refresh=self.openIndex()
+        except Exception,e:
+            log.exception('Cannot open the index')
+            self.failed.emit(str(e))
+            return
+        try:
+            changed=refresh(index,self.workers,self.include,self.exclude,self.onParsed)
+            self.flush()
+            if self.backend=='server':
+                self.generation=index.generation
+            self.indexReady.emit(changed)
+        except Cancelled:
+            log.info('Indexing cancelled')
+        except Exception,e:
+            log.exception('Indexing failed')
+            self.failed.emit(str(e))
+        finally:
+            index.close()
+
+    def refreshRemote(self,index,*args):
+        """ indexserver.refreshRemote, which cancel stops by closing the connection
+
+        The server only replies once its update is done, which may take as
+        long as a full index build.
+
+        """
+        self.remote=index
+        try:
+            if self.cancelled:
+                raise Cancelled()
+            return indexserver.refreshRemote(index,*args)
+        except (socket.error,indexserver.IndexServerError):
+            if self.cancelled:
+                raise Cancelled()
+            raise
+
+    def onParsed(self,module,parsed,found):
+        if self.cancelled:
+            raise Cancelled()
+        if not module is None:
+            # Sorted here, as the module is still written to the index by
+            # this thread once it is shown
+            module.sort()
+            self.batch.append(module)
+        now=time.time()
+        if now-self.lastBatch>=BATCH_SECONDS:
+            self.lastBatch=now
+            self.flush()
+            self.progress.emit(parsed,found)
+
+    def flush(self):
+        if len(self.batch)>0:
+            self.modulesParsed.emit(self.batch)
+            self.batch=[]
+
+class RefOverlay:
+    """ refid to Member lookup of the modules parsed so far
+
+    Used as CodeBrowser.refs while the index is being built.  Members not
+    parsed yet are looked up in the index.
+
+    """
+
+    def __init__(self,index):
+        self.index=index
+        self.members={}
+
+    def addModules(self,modules):
+        for module in modules:
+            for member in module.members:
+                if not member.id in self.members:
+                    self.members[member.id]=member
+
+    def __contains__(self,refid):
+        return refid in self.members or refid in self.index
+
+    def existing(self,refids):
+        found=set([refid for refid in refids if refid in self.members])
+        return found|self.index.existing([refid for refid in refids if not refid in found])
+
+    def moduleOf(self,refid):
+        member=self.members.get(refid)
+        if member is None:
+            return self.index.moduleOf(refid)
+        return member.module
+
+    def get(self,refid,default=None):
+        member=self.members.get(refid)
+        if member is None:
+            return self.index.get(refid,default)
+        return member
@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+""" Index server shared by the browsers working in the same directory
+
+    python indexserver.py [--server SOCKET] [-j N] [--include PATTERN] [--exclude PATTERN]
+
+The server brings cb.db up to date, then answers the queries of browsers
+started with --server on a Unix domain socket (cb.sock by default), so the
+index is read once and kept in memory by a single process.  Modules and
+members stay loaded once a browser asked for them.
+
+Every message is a marshalled tuple preceded by its length as a 4 byte
+big endian integer.  Requests are (op,args...), replies (ok,value), where
+value is the error message if ok is false.  marshal is only safe between
+trusted processes: the socket is only accessible to its owner.
+
+"""
+import os
+import sys
+import errno
+import signal
+import select
+import socket
+import struct
+import marshal
+import logging
+import threading
+import doxyparse
+import cbindex
+import symbols
+from cbindex import IndexedModule, Caller
+from doxyparse import Member
+
+log=logging.getLogger('indexserver')
+
+# Changes kept for clients that did not update since, older clients reload
+MAX_CHANGES=100
+
+class IndexServerError(Exception):
+    pass
+
+def recvAll(sock,size):
+    data=[]
+    while size>0:
+        chunk=sock.recv(size)
+        if len(chunk)==0:
+            raise EOFError()
+        data.append(chunk)
+        size-=len(chunk)
+    return ''.join(data)
+
+def readMessage(sock):
+    """ Returns the next message of a socket, or None if it was closed """
+    try:
+        header=sock.recv(4)
+        if len(header)==0:
+            return None
+        if len(header)<4:
+            header+=recvAll(sock,4-len(header))
+        size=struct.unpack('!I',header)[0]
+        return marshal.loads(recvAll(sock,size))
+    except EOFError:
+        return None
+
+def sendMessage(sock,message):
+    data=marshal.dumps(message)
+    sock.sendall(struct.pack('!I',len(data))+data)
+
+class IndexServer:
+    """ Serves the index of the current directory on a Unix domain socket
+
+    Requests are answered one at a time by a select loop, as the index
+    connection belongs to the main thread.  A refresh runs on a thread with
+    its own connection, and its reply is sent when it is done, so other
+    queries are answered meanwhile.  Each refresh increments the index
+    generation, and a refresh reply gives the XML files changed since the
+    generation the client had, including the changes asked by other clients.
+
+    """
+
+    def __init__(self,address='cb.sock',workers=1,include=None,exclude=None):
+        self.address=address
+        self.workers=workers
+        self.include=include
+        self.exclude=exclude
+        self.index=cbindex.loadIndex(workers=workers,include=include,exclude=exclude)
+        self.index.modules()
+        self.symbols=None
+        self.generation=0
+        self.changes=[]
+        # Clients waiting for the running refresh, and for the next one
+        self.refreshing=None
+        self.waiting=[]
+        self.result=None
+        self.handlers={
+            'generation': lambda: self.generation,
+            'isEmpty': self.index.isEmpty,
+            'xmlDirs': lambda: list(self.index.xmlDirs()),
+            'modules': lambda xmlpath=None: list(self.index.moduleRows(xmlpath)),
+            'members': self.members,
+            'spans': self.spans,
+            'member': self.member,
+            'existing': lambda refids: list(self.index.existing(refids)),
+            'callers': lambda refid: [(c.key,c.name,c.args,c.line,c.srcname) for c in self.index.callers(refid)],
+            'memberByKey': self.memberByKey,
+            'callerCount': self.index.callerCount,
+            'search': self.search,
+            }
+
+    def listen(self):
+        """ Bind the socket, replacing the one a dead server left behind """
+        if os.path.exists(self.address):
+            probe=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+            try:
+                probe.connect(self.address)
+                raise IndexServerError('An index server is already running on {}'.format(self.address))
+            except socket.error:
+                os.remove(self.address)
+            finally:
+                probe.close()
+        listener=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        listener.bind(self.address)
+        os.chmod(self.address,0600)
+        listener.listen(16)
+        return listener
+
+    def serve(self):
+        listener=self.listen()
+        self.wakeRead,self.wakeWrite=os.pipe()
+        clients=[]
+        log.info('Serving %s on %s',os.getcwd(),self.address)
+        try:
+            while True:
+                try:
+                    readable=select.select([listener,self.wakeRead]+clients,[],[])[0]
+                except select.error,e:
+                    if e.args[0]==errno.EINTR:
+                        continue
+                    raise
+                for s in readable:
+                    if s is listener:
+                        conn,addr=listener.accept()
+                        clients.append(conn)
+                    elif s==self.wakeRead:
+                        os.read(self.wakeRead,1)
+                        self.refreshDone()
+                    elif not self.handle(s):
+                        clients.remove(s)
+                        s.close()
+        finally:
+            listener.close()
+            os.remove(self.address)
+
+    def handle(self,conn):
+        """ Answer one request, returns False once the client is gone """
+        try:
+            request=readMessage(conn)
+        except socket.error:
+            request=None
+        if request is None:
+            return False
+        op=request[0]
+        if op=='refresh':
+            self.waiting.append((conn,request[1]))
+            if self.refreshing is None:
+                self.startRefresh()
+            return True
+        handler=self.handlers.get(op)
+        if handler is None:
+            log.warning('Unknown request %s',op)
+            return self.reply(conn,(False,'Unknown request {}'.format(op)))
+        try:
+            reply=(True,handler(*request[1:]))
+        except Exception,e:
+            log.exception('Request %s failed',op)
+            reply=(False,str(e))
+        return self.reply(conn,reply)
+
+    def reply(self,conn,reply):
+        try:
+            sendMessage(conn,reply)
+            return True
+        except socket.error:
+            return False
+
+    def members(self,key):
+        """ Rows of the members of a module, in row order, for Member.assign """
+        module=self.index.getModule(key)
+        if module is None:
+            return []
+        return [(m.id,m.name,m.line,m.args,m.filepath,m.bodyend,[(r.refid,r.ident) for r in m.refs])
+                for m in sorted(module.members,key=lambda m: m.row)]
+
+    def spans(self,key):
+        module=self.index.getModule(key)
+        if module is None:
+            return []
+        return module.codeSpans()
+
+    def member(self,refid):
+        """ Returns the (module key,row) of the member with the given id, or None """
+        m=self.index.get(refid)
+        if m is None:
+            return None
+        return (m.module.key,m.row)
+
+    def memberByKey(self,key):
+        """ Returns the (module key,row) of the member with the given table key, or None """
+        m=self.index.memberByKey(key)
+        if m is None:
+            return None
+        return (m.module.key,m.row)
+
+    def search(self,query,limit=100):
+        if self.symbols is None:
+            self.symbols=symbols.loadSymbols(self.index)
+        return [self.symbols.entry(i) for i in self.symbols.search(query,limit)]
+
+    def startRefresh(self):
+        self.refreshing=self.waiting
+        self.waiting=[]
+        thread=threading.Thread(target=self.refreshIndex)
+        thread.daemon=True
+        thread.start()
+
+    def refreshIndex(self):
+        index=cbindex.Index(self.index.path)
+        try:
+            self.result=cbindex.refreshIndex(index,self.workers,self.include,self.exclude)
+        except Exception,e:
+            log.exception('Index update failed')
+            self.result=e
+        finally:
+            index.close()
+            os.write(self.wakeWrite,'x')
+
+    def refreshDone(self):
+        result=self.result
+        if isinstance(result,Exception):
+            reply=(False,str(result))
+        else:
+            if len(result)>0:
+                self.index.refresh(result)
+                self.symbols=None
+                self.generation+=1
+                self.changes.append((self.generation,result))
+                del self.changes[:-MAX_CHANGES]
+                log.info('Index generation %d: %d XML files changed',self.generation,len(result))
+            reply=None
+        for conn,since in self.refreshing:
+            if reply is None:
+                self.reply(conn,(True,(self.generation,self.changesSince(since))))
+            else:
+                self.reply(conn,reply)
+        self.refreshing=None
+        if len(self.waiting)>0:
+            self.startRefresh()
+
+    def changesSince(self,generation):
+        """ Returns the XML files changed after generation, None if not known """
+        if generation==self.generation:
+            return []
+        if len(self.changes)==0 or self.changes[0][0]>generation+1:
+            return None
+        paths=set()
+        for g,changed in self.changes:
+            if g>generation:
+                paths.update(changed)
+        return list(paths)
+
+class RemoteIndex(cbindex.Index):
+    """ Index whose queries are answered by an IndexServer
+
+    Can be used instead of an Index: modules and members are built from the
+    rows sent by the server and cached, like those read from the database.
+    Members are identified by their module key and row, which are the same
+    in the server and in the client.  Raises socket.error if no server
+    listens on address.
+
+    """
+
+    def __init__(self,address='cb.sock',generation=None):
+        self.address=address
+        self.path=address
+        self.sock=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        self.sock.connect(address)
+        if generation is None:
+            generation=self.call('generation')
+        # Index generation the modules read so far belong to
+        self.generation=generation
+        self.reset()
+
+    def call(self,op,*args):
+        sendMessage(self.sock,(op,)+args)
+        reply=readMessage(self.sock)
+        if reply is None:
+            raise IndexServerError('The index server closed the connection')
+        ok,value=reply
+        if not ok:
+            raise IndexServerError(value)
+        return value
+
+    def close(self):
+        self.sock.close()
+
+    def abort(self):
+        """ Make a call waiting for the server fail, from another thread """
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def isEmpty(self):
+        return self.call('isEmpty')
+
+    def xmlDirs(self):
+        return set(self.call('xmlDirs'))
+
+    def moduleRows(self,xmlpath=None):
+        return self.call('modules',xmlpath)
+
+    def loadMembers(self,module):
+        members=[]
+        for row in self.call('members',module.key):
+            m=Member(module)
+            m.assign(*row)
+            members.append(m)
+            self.members[(module.key,m.row)]=m
+        members.sort(key=lambda member: member.name)
+        return members
+
+    def loadSpans(self,module):
+        for line,col,refid,ident in self.call('spans',module.key):
+            module.addSpan(line,col,refid,ident)
+
+    def existing(self,refids):
+        return set(self.call('existing',list(refids)))
+
+    def memberAt(self,moduleKey,row):
+        if not (moduleKey,row) in self.members:
+            module=self.getModule(moduleKey)
+            if module is None:
+                return None
+            module.members
+        return self.members.get((moduleKey,row))
+
+    def __contains__(self,refid):
+        return not self.call('member',refid) is None
+
+    def moduleOf(self,refid):
+        found=self.call('member',refid)
+        if found is None:
+            return None
+        return self.getModule(found[0])
+
+    def get(self,refid,default=None):
+        found=self.call('member',refid)
+        if found is None:
+            return default
+        member=self.memberAt(*found)
+        if member is None:
+            return default
+        return member
+
+    def memberByKey(self,key):
+        found=self.call('memberByKey',key)
+        if found is None:
+            return None
+        return self.memberAt(*found)
+
+    def callers(self,refid):
+        return [Caller(self,*row) for row in self.call('callers',refid)]
+
+    def callerCount(self,refid):
+        return self.call('callerCount',refid)
+
+    def symbolIndex(self):
+        return RemoteSymbols(self)
+
+class RemoteSymbols:
+    """ Symbol search done by the server, for the SymbolFinder """
+
+    def __init__(self,index):
+        self.index=index
+        self.entries=[]
+
+    def search(self,query,limit=100):
+        self.entries=self.index.call('search',query,limit)
+        return range(len(self.entries))
+
+    def entry(self,i):
+        return tuple(self.entries[i])
+
+def refreshRemote(index,workers=1,include=None,exclude=None,onParsed=None):
+    """ Have the server bring its index up to date, like cbindex.refreshIndex
+
+    The server uses its own options.  Returns the XML files changed since
+    the generation of index, or None if the server no longer knows them,
+    and moves index to the new generation.
+
+    """
+    generation,changed=index.call('refresh',index.generation)
+    index.generation=generation
+    return changed
+
+def main():
+    args,rest=doxyparse.parseArgs(sys.argv[1:])
+    doxyparse.setupArgs(args)
+    server=IndexServer(args.server or 'cb.sock',args.jobs,args.include,args.exclude)
+    # Remove the socket when killed
+    signal.signal(signal.SIGTERM,lambda signum,frame: sys.exit(0))
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        pass
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,85 @@
+from PySide import QtCore
+import os
+import logging
+
+log=logging.getLogger('indexwatcher')
+
+# Changes are handled once no new one came for this long, so a doxygen run
+# writing thousands of files triggers a single update
+DELAY_MS=500
+
+class IndexWatcher(QtCore.QObject):
+    """ Watches the XML directories of the index and the shown source file
+
+    Every XML directory is watched, together with its index.xml, which
+    doxygen rewrites at the end of each run (files changed in place do not
+    always signal their directory).  After a change the index is updated in
+    the background, and a changed source file is shown again.
+
+    """
+
+    def __init__(self,parent=None):
+        super(IndexWatcher,self).__init__(parent)
+        self.watcher=QtCore.QFileSystemWatcher(self)
+        self.watcher.directoryChanged.connect(self.onXMLChanged)
+        self.watcher.fileChanged.connect(self.onFileChanged)
+        self.timer=QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(DELAY_MS)
+        self.timer.timeout.connect(self.onTimeout)
+        self.xmlPaths=set()
+        self.sourcePath=None
+        self.xmlChanged=False
+        self.changedSources=set()
+
+    def watchXMLDirs(self,dirs):
+        """ Watch the given XML directories (and only those) """
+        paths=set()
+        for dir in dirs:
+            paths.add(dir)
+            indexPath=os.path.join(dir,'index.xml')
+            if os.path.exists(indexPath):
+                paths.add(indexPath)
+        old=self.xmlPaths-paths
+        new=paths-self.xmlPaths
+        if len(old)>0:
+            self.watcher.removePaths(list(old))
+        if len(new)>0:
+            self.watcher.addPaths(list(new))
+        self.xmlPaths=paths
+
+    def watchSource(self,path):
+        """ Watch the source file shown in the code view """
+        if path==self.sourcePath:
+            return
+        if not self.sourcePath is None and not self.sourcePath in self.xmlPaths:
+            self.watcher.removePath(self.sourcePath)
+        self.sourcePath=path
+        if not path is None and os.path.exists(path):
+            self.watcher.addPath(path)
+
+    def onXMLChanged(self,path):
+        self.xmlChanged=True
+        self.timer.start()
+
+    def onFileChanged(self,path):
+        if path in self.xmlPaths:
+            self.onXMLChanged(path)
+        else:
+            self.changedSources.add(path)
+            self.timer.start()
+
+    def onTimeout(self):
+        import codebrowser
+        # Files replaced by a rename are no longer watched
+        files=set(self.watcher.files())
+        for path in list(self.xmlPaths)+[self.sourcePath]:
+            if not path is None and not path in files and os.path.isfile(path):
+                self.watcher.addPath(path)
+        if self.xmlChanged:
+            self.xmlChanged=False
+            log.info('XML files changed, updating the index')
+            codebrowser.gBrowser.tree.updateIndex()
+        for path in self.changedSources:
+            codebrowser.gBrowser.sourceChanged(path)
+        self.changedSources=set()
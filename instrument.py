@@ -0,0 +1,113 @@
+""" Opt-in timers and counters for the hot paths, and logging setup
+
+Instrumentation is off by default, and every call then returns at once.
+Once enabled (--stats) the statistics are written to stderr at exit, and
+on demand with dump() (SIGUSR1, or Ctrl+Shift+S in the browser).
+
+Hot paths use start/stop, which cost one test when disabled:
+
+    t=instrument.start()
+    ...
+    instrument.stop('view.paint',t)
+
+Longer blocks can use "with instrument.timed('index.parse'):".
+
+"""
+import sys
+import time
+import atexit
+import signal
+import logging
+
+enabled=False
+# name -> [calls,total seconds,longest]
+timers={}
+counters={}
+
+def setupLogging(level='warning'):
+    """ Configure the root logger from a level name """
+    logging.basicConfig(level=getattr(logging,level.upper(),logging.WARNING),
+                        format='%(levelname)s %(name)s: %(message)s')
+
+def enable(atExit=True):
+    """ Start collecting statistics, dumped at exit if atExit is set """
+    global enabled
+    if enabled:
+        return
+    enabled=True
+    if atExit:
+        atexit.register(dump)
+    if hasattr(signal,'SIGUSR1'):
+        try:
+            signal.signal(signal.SIGUSR1,lambda signum,frame: dump())
+        except ValueError:
+            # Not called from the main thread
+            pass
+
+def reset():
+    timers.clear()
+    counters.clear()
+
+def count(name,n=1):
+    if enabled:
+        counters[name]=counters.get(name,0)+n
+
+def start():
+    """ Returns the start time of a measure, or None if disabled """
+    if enabled:
+        return time.time()
+    return None
+
+def stop(name,started):
+    """ Record the time elapsed since start() under name """
+    if started is None:
+        return
+    addTime(name,time.time()-started)
+
+def addTime(name,seconds):
+    t=timers.get(name)
+    if t is None:
+        timers[name]=[1,seconds,seconds]
+    else:
+        t[0]+=1
+        t[1]+=seconds
+        if seconds>t[2]:
+            t[2]=seconds
+
+class timed:
+    """ Context manager timing a block """
+
+    def __init__(self,name):
+        self.name=name
+        self.started=None
+
+    def __enter__(self):
+        self.started=start()
+        return self
+
+    def __exit__(self,type,value,tb):
+        stop(self.name,self.started)
+        return False
+
+def report():
+    """ Returns the statistics as text, one line per timer and counter """
+    lines=[]
+    if len(timers)>0:
+        lines.append('{:<28} {:>8} {:>12} {:>12} {:>12}'.format('timer','calls','total ms','mean ms','max ms'))
+        for name in sorted(timers):
+            calls,total,longest=timers.get(name)
+            lines.append('{:<28} {:>8} {:>12.2f} {:>12.3f} {:>12.3f}'.format(name,calls,total*1000,total*1000/calls,longest*1000))
+    if len(counters)>0:
+        lines.append('{:<28} {:>8}'.format('counter','value'))
+        for name in sorted(counters):
+            lines.append('{:<28} {:>8}'.format(name,counters.get(name)))
+    return '\n'.join(lines)
+
+def dump(stream=None):
+    """ Write the statistics to stream (stderr by default) """
+    if stream is None:
+        stream=sys.stderr
+    text=report()
+    if len(text)>0:
+        stream.write(text+'\n')
+        stream.flush()
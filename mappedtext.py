@@ -0,0 +1,153 @@
+import os
+import time
+import mmap
+from array import array
+
+# Files smaller than this are read into a list of lines
+MAP_THRESHOLD=4*1024*1024
+# Bytes counted at a time, and lines added to the offset index at a time
+CHUNK=1024*1024
+INDEX_STEP=4096
+# Longest time a mapped file is trusted to be unchanged between two checks
+CHECK_SECONDS=0.05
+
+class MappedText:
+    """ Read only sequence of the lines of a file, backed by mmap
+
+    Only the number of lines is computed when the file is opened.  The
+    offsets of the line starts are indexed as far as the lines read so far,
+    and a line is sliced from the mapping each time it is read, so the file
+    is never copied as a whole.  Like str.split('\\n'), a file ending with a
+    new line has a last, empty line.
+
+    Reading the mapping past the end of a file truncated meanwhile kills
+    the process with SIGBUS, and editors may rewrite the file in place.  So
+    the file is checked before the mapping is read: before each paint (see
+    check), once per INDEX_STEP lines when iterating, and otherwise at most
+    every CHECK_SECONDS.  Once it changed, lines come from a fresh read of
+    the file instead (see changed).
+
+    """
+
+    def __init__(self,path):
+        self.file=open(path,'rb')
+        st=os.fstat(self.file.fileno())
+        self.signature=(st.st_size,st.st_mtime)
+        self.data=mmap.mmap(self.file.fileno(),0,access=mmap.ACCESS_READ)
+        self.fallback=None
+        self.checked=time.time()
+        self.size=len(self.data)
+        self.lineCount=self.countLines()+1
+        self.offsets=array('l',[0])
+        # Longest line indexed so far
+        self.longest=0
+        self.longestLength=0
+
+    def countLines(self):
+        count=0
+        for start in xrange(0,self.size,CHUNK):
+            count+=self.data[start:start+CHUNK].count('\n')
+        return count
+
+    def changed(self,force=False):
+        """ True once the file was changed since it was mapped
+
+        The lines of the changed file are then read, and are used until the
+        document is reloaded.  The number of lines is kept meanwhile, lines
+        past the end of the new text are empty.  Unless force is set, the
+        file is not checked again before CHECK_SECONDS.
+
+        """
+        if self.fallback is None:
+            now=time.time()
+            if not force and now-self.checked<CHECK_SECONDS:
+                return False
+            st=os.fstat(self.file.fileno())
+            if (st.st_size,st.st_mtime)==self.signature:
+                self.checked=now
+                return False
+            self.file.seek(0)
+            self.fallback=self.file.read().split('\n')
+            self.data.close()
+        return True
+
+    def check(self):
+        """ Check the file now, e.g. before a paint reads many lines """
+        return self.changed(True)
+
+    def indexTo(self,line):
+        """ Extend the offset index so that line (0 based) can be sliced """
+        offsets=self.offsets
+        if len(offsets)>line+1 or len(offsets)==self.lineCount or self.changed():
+            return
+        find=self.data.find
+        stop=min(line+INDEX_STEP,self.lineCount-1)
+        start=offsets[-1]
+        while len(offsets)<=stop:
+            pos=find('\n',start)
+            if pos-start>self.longestLength:
+                self.longestLength=pos-start
+                self.longest=len(offsets)-1
+            start=pos+1
+            offsets.append(start)
+        if len(offsets)==self.lineCount and self.size-start>self.longestLength:
+            self.longestLength=self.size-start
+            self.longest=len(offsets)-1
+
+    def __len__(self):
+        return self.lineCount
+
+    def __getitem__(self,line):
+        if line<0:
+            line+=self.lineCount
+        if line<0 or line>=self.lineCount:
+            raise IndexError(line)
+        if not self.changed():
+            self.indexTo(line)
+            if self.fallback is None:
+                return self.sliceLine(line)
+        if line<len(self.fallback):
+            return self.fallback[line]
+        return ''
+
+    def sliceLine(self,line):
+        """ Returns a line from the mapping, which must be indexed and checked """
+        start=self.offsets[line]
+        if line+1<len(self.offsets):
+            return self.data[start:self.offsets[line+1]-1]
+        return self.data[start:self.size]
+
+    def __iter__(self):
+        for start in xrange(0,self.lineCount,INDEX_STEP):
+            stop=min(start+INDEX_STEP,self.lineCount)
+            # Checked once per step, then the lines are sliced right away
+            if not self.check():
+                self.indexTo(stop-1)
+                if self.fallback is None:
+                    for line in xrange(start,stop):
+                        yield self.sliceLine(line)
+                    continue
+            for line in xrange(start,stop):
+                yield self[line]
+
+    def longestLine(self):
+        """ Returns the longest line among the lines indexed so far """
+        self.indexTo(0)
+        return self[self.longest]
+
+    def memorySize(self):
+        """ Memory used besides the mapping, which is shared with the page cache """
+        size=self.offsets.itemsize*len(self.offsets)+200
+        if not self.fallback is None:
+            size+=sum([len(line)+40 for line in self.fallback])
+        return size
+
+def readLines(path):
+    """ Returns the lines of a file, memory mapped if the file is large """
+    if os.path.getsize(path)>=MAP_THRESHOLD:
+        return MappedText(path)
+    f=open(path,'r')
+    try:
+        return f.read().split('\n')
+    finally:
+        f.close()
@@ -0,0 +1,167 @@
+from PySide import QtCore
+from PySide import QtGui
+import os
+import time
+import logging
+from mappedtext import readLines
+from indexloader import Cancelled
+from occurrences import OccurrenceIndex, occurrencePath, searchOccurrences
+import shardindex
+
+log=logging.getLogger('occurrencelist')
+
+# Longest time found lines are held back before being shown
+BATCH_SECONDS=0.1
+
+class OccurrenceSearch(QtCore.QThread):
+    """ Finds the lines an identifier appears on, on a worker thread
+
+    The thread has its own connection to the occurrence index, which it
+    brings up to date while searching.  Found lines are handed to the panel
+    in batches, with their text, as they are found.  With a sharded index,
+    paths is None and the source files are read from the shards directory
+    on the thread.
+
+    """
+    found=QtCore.Signal(object)
+    # Number of source files scanned
+    done=QtCore.Signal(int)
+    failed=QtCore.Signal(str)
+
+    def __init__(self,path,word,paths,workers=1,parent=None,shards=None):
+        super(OccurrenceSearch,self).__init__(parent)
+        self.path=path
+        self.word=word
+        self.paths=paths
+        self.shards=shards
+        self.workers=workers
+        self.cancelled=False
+        self.batch=[]
+        self.lastBatch=0
+
+    def cancel(self):
+        self.cancelled=True
+
+    def checkCancel(self):
+        if self.cancelled:
+            raise Cancelled()
+
+    def run(self):
+        self.lastBatch=time.time()
+        index=OccurrenceIndex(self.path)
+        try:
+            paths=self.paths
+            if paths is None:
+                paths=shardindex.sourcePaths(self.shards,self.checkCancel)
+            scanned=searchOccurrences(index,self.word,paths,self.workers,self.onFound,self.checkCancel)
+            self.flush()
+            self.done.emit(scanned)
+        except Cancelled:
+            log.info('Search of %s cancelled',self.word)
+        except Exception,e:
+            log.exception('Search of %s failed',self.word)
+            self.failed.emit(str(e))
+        finally:
+            index.close()
+
+    def onFound(self,path,lines):
+        self.checkCancel()
+        text=readLines(path)
+        for line in lines:
+            if line<=len(text):
+                self.batch.append((path,line,text[line-1].strip()))
+        now=time.time()
+        if now-self.lastBatch>=BATCH_SECONDS:
+            self.lastBatch=now
+            self.flush()
+
+    def flush(self):
+        if len(self.batch)>0:
+            self.found.emit(self.batch)
+            self.batch=[]
+
+class OccurrenceList(QtGui.QDockWidget):
+    """ Lists every line of the indexed sources where an identifier appears
+
+    Unlike the callers panel, this is a textual search, so it also finds
+    the uses doxygen did not resolve.  Lines are listed as they are found.
+
+    """
+
+    def __init__(self,parent=None):
+        super(OccurrenceList,self).__init__('Occurrences',parent)
+        self.edit=QtGui.QLineEdit()
+        self.list=QtGui.QListWidget()
+        layout=QtGui.QVBoxLayout()
+        layout.setContentsMargins(0,0,0,0)
+        layout.addWidget(self.edit)
+        layout.addWidget(self.list)
+        widget=QtGui.QWidget()
+        widget.setLayout(layout)
+        self.setWidget(widget)
+        self.results=[]
+        self.search=None
+        self.word=''
+        self.workers=1
+        self.edit.returnPressed.connect(self.onReturnPressed)
+        self.list.itemDoubleClicked.connect(self.onDoubleClick)
+
+    def find(self,word):
+        """ Search the occurrences of word, replacing the current search """
+        self.stop()
+        import codebrowser
+        tree=codebrowser.gBrowser.tree
+        if tree.index is None:
+            return
+        self.word=word
+        self.edit.setText(word)
+        self.results=[]
+        self.list.clear()
+        self.setWindowTitle('Searching {}...'.format(word))
+        shards=None
+        if tree.backend=='shards':
+            shards=tree.index.dir
+        self.search=OccurrenceSearch(occurrencePath(tree.index.path),word,tree.sourcePaths(),self.workers,self,shards)
+        self.search.found.connect(self.onFound)
+        self.search.done.connect(self.onDone)
+        self.search.failed.connect(self.onFailed)
+        self.search.start()
+
+    def stop(self):
+        """ Cancel the running search, e.g. when the browser is closed """
+        if not self.search is None:
+            self.search.cancel()
+            self.search.wait()
+            self.search=None
+
+    def onFound(self,batch):
+        # Batches of a cancelled search may still be queued
+        if self.sender() is not self.search:
+            return
+        for path,line,text in batch:
+            self.results.append((path,line))
+            self.list.addItem('{}:{}  {}'.format(os.path.basename(path),line,text))
+
+    def onDone(self,scanned):
+        if self.sender() is not self.search:
+            return
+        self.search=None
+        self.setWindowTitle('{} occurrences of {}'.format(len(self.results),self.word))
+
+    def onFailed(self,message):
+        if self.sender() is not self.search:
+            return
+        self.search=None
+        self.setWindowTitle('Search failed: {}'.format(message))
+
+    def onReturnPressed(self):
+        word=self.edit.text().strip().encode('utf-8')
+        if len(word)>0:
+            self.find(word)
+
+    def onDoubleClick(self,item):
+        row=self.list.row(item)
+        if row>=0 and row<len(self.results):
+            import codebrowser
+            path,line=self.results[row]
+            codebrowser.gBrowser.gotoLocation(path,line)
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+import os
+import sys
+import re
+import sqlite3
+import logging
+import itertools
+import multiprocessing
+import instrument
+from array import array
+from mappedtext import readLines
+
+log=logging.getLogger('occurrences')
+
+SCHEMA='''
+CREATE TABLE IF NOT EXISTS files(key INTEGER PRIMARY KEY, path TEXT UNIQUE, mtime REAL, size INTEGER);
+CREATE TABLE IF NOT EXISTS postings(word TEXT, file INTEGER, lines BLOB);
+CREATE INDEX IF NOT EXISTS postings_word ON postings(word);
+CREATE INDEX IF NOT EXISTS postings_file ON postings(file);
+'''
+
+# Scanned files are committed in groups of this many
+COMMIT_FILES=200
+
+# Same identifiers as codeedit.identifier
+identifier=re.compile(r'[^\d\W]\w*')
+
+def occurrencePath(indexPath):
+    """ The occurrence index is stored next to the index database """
+    return os.path.splitext(indexPath)[0]+'.occ'
+
+def fileSignature(path):
+    """ Returns (mtime,size) of a file, or None if it cannot be read """
+    try:
+        st=os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime,st.st_size)
+
+def scanFile(path):
+    """ Returns (path,signature,postings) of a source file
+
+    postings maps every identifier of the file to the array of the lines
+    (1 based) it appears on.  signature and postings are None if the file
+    cannot be read.  This is a module level function so it can be handed to
+    a process pool.
+
+    """
+    sig=fileSignature(path)
+    if sig is None:
+        return (path,None,None)
+    postings={}
+    try:
+        for number,line in enumerate(readLines(path)):
+            for word in set(identifier.findall(line)):
+                lines=postings.get(word)
+                if lines is None:
+                    lines=postings[word]=array('i')
+                lines.append(number+1)
+    except (IOError,OSError):
+        return (path,None,None)
+    return (path,sig,postings)
+
+def iterScans(paths,workers=1):
+    """ Scan source files, yielding the scanFile results as they are ready
+
+    With workers>1 (below 1: one per CPU) the files are spread over a pool
+    of processes, and results come in no particular order.
+
+    """
+    if workers<1:
+        workers=multiprocessing.cpu_count()
+    paths=list(paths)
+    if workers==1 or len(paths)<2:
+        for path in paths:
+            yield scanFile(path)
+        return
+    pool=multiprocessing.Pool(min(workers,len(paths)))
+    finished=False
+    try:
+        for result in pool.imap_unordered(scanFile,paths,4):
+            yield result
+        finished=True
+    finally:
+        if finished:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
+
+class OccurrenceIndex:
+    """ Persistent posting lists of the identifiers of the source files
+
+    For every file and identifier, the lines the identifier appears on are
+    stored as an array blob, so finding all occurrences of an identifier is
+    an index lookup, and the files are only read to show the lines found.
+    Files are rescanned when their mtime or size changes.
+
+    """
+
+    def __init__(self,path='cb.occ'):
+        self.path=path
+        self.db=sqlite3.connect(path)
+        self.db.text_factory=str
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def files(self):
+        """ Returns the (key,mtime,size) of the indexed files by path """
+        return dict([(path,(key,mtime,size)) for key,path,mtime,size in
+                     self.db.execute('SELECT key,path,mtime,size FROM files')])
+
+    def changes(self,paths,checkCancel=None):
+        """ Returns (stale,removed): the paths to rescan and the files to drop
+
+        checkCancel is called for every file, see searchOccurrences.
+
+        """
+        files=self.files()
+        paths=set(paths)
+        stale=[]
+        for path in paths:
+            if not checkCancel is None:
+                checkCancel()
+            indexed=files.get(path)
+            if indexed is None or fileSignature(path)!=indexed[1:]:
+                stale.append(path)
+        removed=[path for path in files if not path in paths]
+        return stale,removed
+
+    def removeFiles(self,paths):
+        with self.db:
+            for path in paths:
+                row=self.db.execute('SELECT key FROM files WHERE path=?',(path,)).fetchone()
+                if not row is None:
+                    self.db.execute('DELETE FROM postings WHERE file=?',row)
+                    self.db.execute('DELETE FROM files WHERE key=?',row)
+
+    def replaceFile(self,path,sig,postings):
+        """ Store the postings of a scanned file, or drop it if it is unreadable
+
+        The change is part of the current transaction, see commit.
+
+        """
+        db=self.db
+        row=db.execute('SELECT key FROM files WHERE path=?',(path,)).fetchone()
+        if not row is None:
+            db.execute('DELETE FROM postings WHERE file=?',row)
+            db.execute('DELETE FROM files WHERE key=?',row)
+        if sig is None:
+            return
+        key=db.execute('INSERT INTO files(path,mtime,size) VALUES (?,?,?)',(path,)+sig).lastrowid
+        db.executemany('INSERT INTO postings(word,file,lines) VALUES (?,?,?)',
+                       [(word,key,buffer(lines.tostring())) for word,lines in postings.iteritems()])
+
+    def commit(self):
+        self.db.commit()
+
+    def lookup(self,word,skip=()):
+        """ Yields (path,lines) of the files containing word, except those in skip """
+        rows=self.db.execute('SELECT files.path,postings.lines FROM postings JOIN files ON files.key=postings.file '
+                             'WHERE postings.word=? ORDER BY files.path',(word,))
+        for path,blob in rows:
+            if path in skip:
+                continue
+            lines=array('i')
+            lines.fromstring(str(blob))
+            yield path,lines
+
+def searchOccurrences(index,word,paths,workers=1,onFound=None,checkCancel=None):
+    """ Find all occurrences of word in the files paths, updating the index
+
+    onFound(path,lines) is called for each file containing word: first for
+    the files whose postings are up to date, then for the changed files as
+    they are scanned, so results come before the update is complete.
+    Files no longer in paths are dropped from the index.  checkCancel() is
+    called for every file checked or scanned, and stops the search by
+    raising.  Returns the number of files scanned.
+
+    """
+    stale,removed=index.changes(paths,checkCancel)
+    if len(removed)>0:
+        index.removeFiles(removed)
+    skip=set(stale)
+    with instrument.timed('occurrences.lookup'):
+        for path,lines in index.lookup(word,skip):
+            if not onFound is None:
+                onFound(path,lines)
+    if len(stale)>0:
+        log.info('Scanning %d source files for identifiers',len(stale))
+    try:
+        with instrument.timed('occurrences.scan'):
+            for n,(path,sig,postings) in enumerate(iterScans(sorted(stale),workers)):
+                if not checkCancel is None:
+                    checkCancel()
+                instrument.count('occurrences.files')
+                index.replaceFile(path,sig,postings)
+                if n%COMMIT_FILES==COMMIT_FILES-1:
+                    index.commit()
+                if not postings is None and word in postings and not onFound is None:
+                    onFound(path,postings[word])
+    finally:
+        # Files scanned before a cancel are kept
+        index.commit()
+    return len(stale)
+
+def main():
+    import cbindex
+    index=cbindex.Index()
+    occurrences=OccurrenceIndex(occurrencePath(index.path))
+    paths=set([m.srcpath for m in index.modules() if len(m.srcpath)>0])
+    def show(path,lines):
+        text=readLines(path)
+        for line in lines:
+            print '{}:{}: {}'.format(path,line,text[line-1].strip())
+    for word in sys.argv[1:]:
+        searchOccurrences(occurrences,word,paths,0,show)
+    occurrences.close()
+
+if __name__=='__main__':
+    main()
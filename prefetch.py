@@ -0,0 +1,97 @@
+from PySide import QtCore
+import logging
+import itertools
+import instrument
+
+log=logging.getLogger('prefetch')
+
+# Most modules prepared ahead for one shown module
+PREFETCH_MODULES=8
+# Most refids resolved by one timer step
+REFIDS_PER_STEP=64
+
+def outgoingRefids(module):
+    """ Yields the distinct refids a module refers to, in source order """
+    seen=set()
+    spans=module.codeSpans()
+    if len(spans)>0:
+        refids=(refid for line,col,refid,ident in spans)
+    else:
+        refids=(ref.refid for member in module.members for ref in member.refs)
+    for refid in refids:
+        if not refid in seen:
+            seen.add(refid)
+            yield refid
+
+class Prefetcher(QtCore.QObject):
+    """ Prepares the modules the shown module refers to, while the user is idle
+
+    The work is split in steps run from a zero delay timer, so it only uses
+    the time the event loop would otherwise spend waiting: each step
+    resolves up to REFIDS_PER_STEP distinct refids to their module, without
+    loading its members, until it finds a module that is not in the view
+    cache, and prepares it.  Following a link to a prefetched module then needs
+    no disk access or highlighting.  Showing another module starts over.
+    The view cache keeps prefetched documents from taking over the entries
+    of visited ones.
+
+    """
+
+    def __init__(self,browser,limit=PREFETCH_MODULES):
+        super(Prefetcher,self).__init__(browser)
+        self.browser=browser
+        self.limit=limit
+        self.timer=QtCore.QTimer(self)
+        self.timer.setInterval(0)
+        self.timer.timeout.connect(self.onTimeout)
+        self.refids=None
+        self.seen=set()
+        self.prepared=0
+
+    def start(self,module):
+        """ Prefetch the modules referred to by module """
+        self.refids=outgoingRefids(module)
+        self.seen=set([module.srcpath])
+        self.prepared=0
+        self.timer.start()
+
+    def stop(self):
+        self.timer.stop()
+        self.refids=None
+
+    def onTimeout(self):
+        cache=self.browser.cache
+        if self.prepared>=self.limit:
+            self.stop()
+            return
+        # Few refids at a time, the timer calls again while the user is idle
+        handled=0
+        for refid in itertools.islice(self.refids,REFIDS_PER_STEP):
+            handled+=1
+            module=self.moduleOf(refid)
+            if module is None or module.srcpath is None or module.srcpath in self.seen:
+                continue
+            self.seen.add(module.srcpath)
+            if module.srcpath in cache:
+                continue
+            try:
+                self.browser.prepareModule(module,True)
+            except (IOError,OSError),e:
+                log.debug('Cannot prefetch %s: %s',module.srcpath,e)
+                continue
+            instrument.count('prefetch.module')
+            self.prepared+=1
+            return
+        if handled<REFIDS_PER_STEP:
+            # No refids left
+            self.stop()
+
+    def moduleOf(self,refid):
+        """ Returns the module defining refid, without loading its members if possible """
+        refs=self.browser.refs
+        if hasattr(refs,'moduleOf'):
+            return refs.moduleOf(refid)
+        member=refs.get(refid)
+        if member is None:
+            return None
+        return member.module
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+import os
+import sys
+import sqlite3
+import logging
+import itertools
+import doxyparse
+import symbols
+import instrument
+import cbindex
+
+log=logging.getLogger('shardindex')
+
+ROUTES_SCHEMA='''
+CREATE TABLE IF NOT EXISTS shards(key INTEGER PRIMARY KEY, xmldir TEXT UNIQUE);
+CREATE TABLE IF NOT EXISTS routes(prefix TEXT, shard INTEGER);
+CREATE TABLE IF NOT EXISTS callers(prefix TEXT, shard INTEGER);
+CREATE INDEX IF NOT EXISTS routes_shard ON routes(shard);
+CREATE INDEX IF NOT EXISTS callers_shard ON callers(shard);
+'''
+
+def refidPrefix(refid):
+    """ Returns the compound part of a member id (classFoo of classFoo_1a2b3c) """
+    i=refid.rfind('_1')
+    if i>0:
+        return refid[:i]
+    return refid
+
+class Shard:
+    """ The index of one XML directory, opened when first needed """
+
+    def __init__(self,key,xmldir,path):
+        self.key=key
+        self.xmldir=xmldir
+        self.path=path
+        self.name=os.path.normpath(xmldir)
+        self.index=None
+
+    def open(self):
+        if self.index is None:
+            log.debug('Opening shard %s',self.name)
+            instrument.count('shard.open')
+            self.index=cbindex.Index(self.path)
+        return self.index
+
+    def isOpen(self):
+        return not self.index is None
+
+    def close(self):
+        if not self.index is None:
+            self.index.close()
+            self.index=None
+
+class ShardedIndex:
+    """ Index split in one cbindex.Index per XML directory
+
+    Meant for trees of separately documented components: the doxygen
+    output of each component has its own database in the shards
+    directory.  Only the routing table is read at startup.  It maps the
+    compound part of member ids to the shards defining such members, and
+    to the shards referring to them, so looking up a refid or its callers
+    only opens the shards that may hold it.  Startup cost does not depend
+    on the number of shards or modules.
+
+    """
+
+    def __init__(self,dir='cb.shards'):
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+        self.dir=dir
+        # The symbol index of all shards is stored next to the routing table
+        self.path=os.path.join(dir,'routes.db')
+        self.db=sqlite3.connect(self.path)
+        self.db.text_factory=str
+        self.db.executescript(ROUTES_SCHEMA)
+        self.shards={}
+        self.loadRoutes()
+
+    def loadRoutes(self):
+        """ Read the shard list and the routing table, e.g. after an update """
+        shards={}
+        for key,xmldir in self.db.execute('SELECT key,xmldir FROM shards'):
+            shard=self.shards.get(key)
+            if shard is None or shard.xmldir!=xmldir:
+                shard=Shard(key,xmldir,self.shardPath(key))
+            shards[key]=shard
+        for key,shard in self.shards.iteritems():
+            if shards.get(key) is not shard:
+                shard.close()
+        self.shards=shards
+        self.routes={}
+        for prefix,key in self.db.execute('SELECT prefix,shard FROM routes'):
+            self.routes.setdefault(prefix,[]).append(key)
+        self.callerRoutes={}
+        for prefix,key in self.db.execute('SELECT prefix,shard FROM callers'):
+            self.callerRoutes.setdefault(prefix,[]).append(key)
+
+    def shardPath(self,key):
+        return os.path.join(self.dir,'{}.db'.format(key))
+
+    def close(self):
+        for shard in self.shards.itervalues():
+            shard.close()
+        self.db.close()
+
+    def reset(self):
+        for shard in self.shards.itervalues():
+            if shard.isOpen():
+                shard.index.reset()
+
+    def isEmpty(self):
+        return len(self.shards)==0
+
+    def shardList(self):
+        """ Returns the shards, sorted by XML directory """
+        return sorted(self.shards.values(),key=lambda shard: shard.name)
+
+    def xmlDirs(self):
+        return set([shard.xmldir for shard in self.shards.itervalues()])
+
+    def shardsOf(self,refid,routes=None):
+        """ Returns the shards the routing table gives for refid """
+        if routes is None:
+            routes=self.routes
+        return [self.shards[key] for key in routes.get(refidPrefix(refid),()) if key in self.shards]
+
+    def moduleForPath(self,srcpath,openShards=False):
+        """ Returns the module of a source file, among the shards opened so far
+
+        With openShards, the other shards are then opened one by one until
+        the file is found, e.g. for a file found by the occurrence search.
+
+        """
+        shards=self.shardList()
+        for shard in [s for s in shards if s.isOpen()]+[s for s in shards if not s.isOpen()]:
+            if not shard.isOpen() and not openShards:
+                break
+            for module in shard.open().modules():
+                if module.srcpath==srcpath:
+                    return module
+        return None
+
+    def refresh(self,xmlpaths):
+        """ Reload the routes, and the modules of changed XML files in open shards
+
+        Returns (removed,added) lists of modules, like Index.refresh.
+
+        """
+        opened=[(shard,shard.index.moduleList or []) for shard in self.shards.itervalues() if shard.isOpen()]
+        self.loadRoutes()
+        removed=[]
+        added=[]
+        for shard,modules in opened:
+            if self.shards.get(shard.key) is not shard:
+                # The shard was dropped, with all its modules
+                removed.extend(modules)
+                continue
+            paths=[path for path in xmlpaths if os.path.dirname(path)==shard.xmldir]
+            if len(paths)>0:
+                r,a=shard.index.refresh(paths)
+                removed.extend(r)
+                added.extend(a)
+        return removed,added
+
+    def __contains__(self,refid):
+        for shard in self.shardsOf(refid):
+            if refid in shard.open():
+                return True
+        return False
+
+    def get(self,refid,default=None):
+        for shard in self.shardsOf(refid):
+            member=shard.open().get(refid)
+            if not member is None:
+                return member
+        return default
+
+    def moduleOf(self,refid):
+        for shard in self.shardsOf(refid):
+            module=shard.open().moduleOf(refid)
+            if not module is None:
+                return module
+        return None
+
+    def existing(self,refids):
+        """ Returns the subset of refids that are member ids """
+        byShard={}
+        for refid in refids:
+            for shard in self.shardsOf(refid):
+                byShard.setdefault(shard,[]).append(refid)
+        found=set()
+        for shard,ids in byShard.iteritems():
+            found|=shard.open().existing(ids)
+        return found
+
+    def callers(self,refid):
+        result=[]
+        for shard in self.shardsOf(refid,self.callerRoutes):
+            result.extend(shard.open().callers(refid))
+        result.sort(key=lambda caller: (caller.name,caller.srcname))
+        return result
+
+    def callerCount(self,refid):
+        return sum([shard.open().callerCount(refid) for shard in self.shardsOf(refid,self.callerRoutes)])
+
+    def symbolRows(self):
+        """ Returns (id,name,args,filepath) of all members, opening every shard """
+        return itertools.chain(*[shard.open().symbolRows() for shard in self.shardList()])
+
+    def addShard(self,xmldir):
+        """ Returns the shard of an XML directory, created if needed """
+        for shard in self.shards.itervalues():
+            if shard.xmldir==xmldir:
+                return shard
+        with self.db:
+            key=self.db.execute('INSERT INTO shards(xmldir) VALUES (?)',(xmldir,)).lastrowid
+        shard=Shard(key,xmldir,self.shardPath(key))
+        self.shards[key]=shard
+        return shard
+
+    def removeShard(self,shard):
+        """ Drop the shard of an XML directory that no longer exists """
+        shard.close()
+        with self.db:
+            self.db.execute('DELETE FROM routes WHERE shard=?',(shard.key,))
+            self.db.execute('DELETE FROM callers WHERE shard=?',(shard.key,))
+            self.db.execute('DELETE FROM shards WHERE key=?',(shard.key,))
+        del self.shards[shard.key]
+        if os.path.exists(shard.path):
+            os.remove(shard.path)
+
+    def updateRoutes(self,shard):
+        """ Record the member id prefixes defined and referred to by a shard """
+        db=shard.open().db
+        defined=set([refidPrefix(row[0]) for row in db.execute('SELECT DISTINCT id FROM members')])
+        called=set([refidPrefix(row[0]) for row in db.execute('SELECT DISTINCT refid FROM refs')])
+        with self.db:
+            self.db.execute('DELETE FROM routes WHERE shard=?',(shard.key,))
+            self.db.execute('DELETE FROM callers WHERE shard=?',(shard.key,))
+            self.db.executemany('INSERT INTO routes(prefix,shard) VALUES (?,?)',
+                                [(prefix,shard.key) for prefix in defined])
+            self.db.executemany('INSERT INTO callers(prefix,shard) VALUES (?,?)',
+                                [(prefix,shard.key) for prefix in called])
+
+def refreshShards(index,workers=1,include=None,exclude=None,onParsed=None):
+    """ Bring every shard up to date with its XML directory
+
+    Shards are created for new XML directories and dropped with theirs.
+    The routing table of a shard is rebuilt when its modules change, and
+    the symbol index of all shards whenever any shard changes.  Arguments
+    are those of cbindex.refreshIndex, the counts given to onParsed add up
+    over all shards.  Returns the XML files whose modules changed.
+
+    """
+    changed=[]
+    # Files parsed in the shards done so far, and in the current shard
+    before=[0]
+    current=[0]
+    def parsed(module,count,found):
+        current[0]=count
+        if not onParsed is None:
+            onParsed(module,before[0]+count,before[0]+found)
+    found=set()
+    dirs=doxyparse.walkXMLDirs('.',include,exclude,min(max(workers,1),8))
+    with instrument.timed('index.update'):
+        for xmldir in dirs:
+            found.add(xmldir)
+            shard=index.addShard(xmldir)
+            current[0]=0
+            paths=cbindex.updateIndex(shard.open(),doxyparse.listXMLFiles([xmldir]),workers,parsed)
+            before[0]+=current[0]
+            if len(paths)>0:
+                log.info('Shard %s: %d files changed',shard.name,len(paths))
+                index.updateRoutes(shard)
+                changed.extend(paths)
+            # Shards are reopened when needed, so only the browsed ones stay open
+            shard.close()
+        for shard in index.shardList():
+            if not shard.xmldir in found:
+                log.info('Dropping shard %s',shard.name)
+                changed.extend(shard.open().sources().keys())
+                index.removeShard(shard)
+    if changed or not os.path.exists(symbols.symbolPath(index.path)):
+        with instrument.timed('index.symbols'):
+            symbols.buildSymbols(index)
+            for shard in index.shardList():
+                shard.close()
+    return changed
+
+def sourcePaths(dir='cb.shards',checkCancel=None):
+    """ Returns the source files of all shards, read with a connection of the caller
+
+    Opens every shard, so it is meant for worker threads.  checkCancel is
+    called for each shard and stops by raising.
+
+    """
+    index=ShardedIndex(dir)
+    try:
+        paths=set()
+        for shard in index.shardList():
+            if not checkCancel is None:
+                checkCancel()
+            paths.update([m.srcpath for m in shard.open().modules() if len(m.srcname)>0])
+            shard.close()
+        return paths
+    finally:
+        index.close()
+
+def main():
+    import argparse
+    parser=argparse.ArgumentParser(description='Bring the sharded index in cb.shards up to date')
+    parser.add_argument('-j','--jobs',type=int,default=1)
+    args=parser.parse_args()
+    index=ShardedIndex()
+    changed=refreshShards(index,args.jobs)
+    print '{} shards, {} XML files changed'.format(len(index.shards),len(changed))
+    index.close()
+
+if __name__=='__main__':
+    main()
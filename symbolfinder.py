@@ -0,0 +1,68 @@
+from PySide import QtCore
+from PySide import QtGui
+import os
+from symbols import loadSymbols
+
+class SymbolFinder(QtGui.QDialog):
+    """ "Go to symbol" popup
+
+    Lists the members matching the typed text, ranked by the symbol index,
+    and jumps to the selected one.
+
+    """
+
+    def __init__(self,parent=None):
+        super(SymbolFinder,self).__init__(parent)
+        self.setWindowTitle('Go to symbol')
+        self.symbols=None
+        self.edit=QtGui.QLineEdit()
+        self.results=QtGui.QListWidget()
+        layout=QtGui.QVBoxLayout()
+        layout.addWidget(self.edit)
+        layout.addWidget(self.results)
+        self.setLayout(layout)
+        self.resize(600,400)
+        self.edit.textChanged.connect(self.onTextChanged)
+        self.edit.returnPressed.connect(self.onReturnPressed)
+        self.results.itemActivated.connect(self.onActivated)
+
+    def find(self,index):
+        """ Show the finder for the members of an index """
+        if self.symbols is None:
+            self.symbols=loadSymbols(index)
+        self.edit.selectAll()
+        self.show()
+        self.raise_()
+        self.activateWindow()
+        self.edit.setFocus()
+
+    def onTextChanged(self,text):
+        self.results.clear()
+        if self.symbols is None:
+            return
+        for i in self.symbols.search(text.encode('utf-8')):
+            id,name,args,filepath=self.symbols.entry(i)
+            item=QtGui.QListWidgetItem('{}{}    {}'.format(name,args,os.path.basename(filepath)))
+            item.setData(QtCore.Qt.UserRole,id)
+            item.setToolTip(filepath)
+            self.results.addItem(item)
+        if self.results.count()>0:
+            self.results.setCurrentRow(0)
+
+    def keyPressEvent(self,event):
+        """ Let the arrow keys move the selection while typing """
+        if event.key() in (QtCore.Qt.Key_Up,QtCore.Qt.Key_Down,QtCore.Qt.Key_PageUp,QtCore.Qt.Key_PageDown):
+            QtGui.QApplication.sendEvent(self.results,event)
+        else:
+            super(SymbolFinder,self).keyPressEvent(event)
+
+    def onReturnPressed(self):
+        item=self.results.currentItem()
+        if not item is None:
+            self.onActivated(item)
+
+    def onActivated(self,item):
+        refid=item.data(QtCore.Qt.UserRole)
+        self.hide()
+        import codebrowser
+        codebrowser.gBrowser.gotoSymbol(refid)
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+import os
+import sys
+import marshal
+from array import array
+from bisect import bisect_left
+
+# Rank of substring matches, lower is better
+WORD=0
+SUBSTRING=1
+
+# Longest trigram postings used for fuzzy matching
+FUZZY_POSTINGS=4096
+
+def trigrams(s):
+    """ Returns the set of 3 character substrings of s """
+    return set([s[i:i+3] for i in xrange(len(s)-2)])
+
+class SymbolIndex:
+    """ Trigram index of all member names, for the "go to symbol" finder
+
+    Entries (member id, name, args, file) are sorted by lower case name.
+    Names that are equal ignoring case share one key, and the trigram
+    postings list key numbers in ascending order.  Prefix matches are found
+    by binary search in the sorted keys.  Substring queries intersect the
+    postings of the query trigrams, starting from the shortest, so their
+    cost depends on the number of candidates and not on the index size.
+
+    """
+
+    def __init__(self):
+        self.ids=[]
+        self.names=[]
+        self.args=[]
+        self.files=[]
+        self.fileIndex=array('i')
+        self.keys=[]
+        self.keyStart=array('i',[0])
+        self.postings={}
+
+    def build(self,rows):
+        """ Build the index from (id,name,args,filepath) tuples
+
+        Members read from program listing lines duplicate the id of the
+        member definition, and are only kept if there is no definition.
+
+        """
+        byId={}
+        for id,name,args,filepath in rows:
+            if name and (not id in byId or not byId.get(id)[3]):
+                byId[id]=(name.lower(),name,filepath,args,id)
+        entries=byId.values()
+        entries.sort()
+        fileNumbers={}
+        postings={}
+        lastKey=None
+        for key,name,filepath,args,id in entries:
+            if key!=lastKey:
+                if not lastKey is None:
+                    self.keyStart.append(len(self.ids))
+                k=len(self.keys)
+                self.keys.append(key)
+                for gram in trigrams(key):
+                    posting=postings.get(gram)
+                    if posting is None:
+                        posting=array('i')
+                        postings[gram]=posting
+                    posting.append(k)
+                lastKey=key
+            if not filepath in fileNumbers:
+                fileNumbers[filepath]=len(self.files)
+                self.files.append(filepath)
+            self.fileIndex.append(fileNumbers.get(filepath))
+            self.ids.append(id)
+            self.names.append(name)
+            self.args.append(args)
+        if len(self.keys)>0:
+            self.keyStart.append(len(self.ids))
+        self.postings=postings
+        return self
+
+    def save(self,path):
+        postings=dict([(gram,p.tostring()) for gram,p in self.postings.iteritems()])
+        data=(self.ids,self.names,self.args,self.files,self.fileIndex.tostring(),
+              self.keys,self.keyStart.tostring(),postings)
+        f=open(path,'wb')
+        try:
+            marshal.dump(data,f)
+        finally:
+            f.close()
+
+    def load(self,path):
+        f=open(path,'rb')
+        try:
+            data=marshal.load(f)
+        finally:
+            f.close()
+        self.ids,self.names,self.args,self.files,fileIndex,self.keys,keyStart,postings=data
+        self.fileIndex=array('i')
+        self.fileIndex.fromstring(fileIndex)
+        self.keyStart=array('i')
+        self.keyStart.fromstring(keyStart)
+        self.postings={}
+        for gram,s in postings.iteritems():
+            p=array('i')
+            p.fromstring(s)
+            self.postings[gram]=p
+        return self
+
+    def __len__(self):
+        return len(self.ids)
+
+    def candidates(self,q):
+        """ Returns the keys containing all trigrams of q, in key order """
+        lists=[]
+        for gram in trigrams(q):
+            p=self.postings.get(gram)
+            if p is None:
+                return []
+            lists.append(p)
+        lists.sort(key=len)
+        result=lists[0]
+        for p in lists[1:]:
+            if len(result)==0:
+                break
+            s=set(p) if len(p)<4*len(result) else None
+            if s is None:
+                # Much longer list, probe it with binary searches
+                out=[]
+                for k in result:
+                    i=bisect_left(p,k)
+                    if i<len(p) and p[i]==k:
+                        out.append(k)
+                result=out
+            else:
+                result=[k for k in result if k in s]
+        return result
+
+    def fuzzyCandidates(self,q,limit):
+        """ Returns keys sharing most of the trigrams of q
+
+        Trigrams shared by too many keys say little about the match, and
+        are skipped to keep the cost bounded.
+
+        """
+        grams=trigrams(q)
+        counts={}
+        for gram in grams:
+            p=self.postings.get(gram)
+            if p is None or len(p)>FUZZY_POSTINGS:
+                continue
+            for k in p:
+                counts[k]=counts.get(k,0)+1
+        need=max(1,(len(grams)+1)/2)
+        found=[(-c,k) for k,c in counts.iteritems() if c>=need]
+        found.sort()
+        return [k for c,k in found[0:limit]]
+
+    def rank(self,q,k):
+        """ Rank of a key that contains q, but does not start with it """
+        key=self.keys[k]
+        pos=key.find(q)
+        name=self.names[self.keyStart[k]]
+        if name[pos-1] in '_:~' or (name[pos].isupper() and not name[pos-1].isupper()):
+            return WORD
+        return SUBSTRING
+
+    def search(self,query,limit=100):
+        """ Find members matching a query
+
+        The first word of the query is matched against the member names,
+        any further words must appear in the member file or arguments.
+        Returns up to limit entry numbers, best matches first: the exact
+        name and names starting with the query (found by binary search in
+        the sorted keys), then names containing it at a word boundary,
+        other substrings, and finally names sharing most trigrams with the
+        query.  Later groups are searched only if the earlier ones did not
+        fill the limit.
+
+        """
+        words=query.split()
+        if len(words)==0:
+            return []
+        q=words[0].lower()
+        filters=[w.lower() for w in words[1:]]
+        result=[]
+        start=bisect_left(self.keys,q)
+        stop=bisect_left(self.keys,q+'\xff')
+        if self.addKeys(xrange(start,stop),filters,result,limit) or len(q)<3:
+            return result
+        found=[k for k in self.candidates(q) if (k<start or k>=stop) and q in self.keys[k]]
+        ranked=[(self.rank(q,k),len(self.keys[k]),k) for k in found]
+        ranked.sort()
+        if self.addKeys([k for r,n,k in ranked],filters,result,limit):
+            return result
+        fuzzy=[k for k in self.fuzzyCandidates(q,limit) if not q in self.keys[k]]
+        self.addKeys(fuzzy,filters,result,limit)
+        return result
+
+    def addKeys(self,keys,filters,result,limit):
+        """ Append the entries of keys that pass the filters to result
+
+        Returns True once result holds limit entries.
+
+        """
+        for k in keys:
+            for i in xrange(self.keyStart[k],self.keyStart[k+1]):
+                if len(filters)>0:
+                    text=(self.files[self.fileIndex[i]]+' '+self.args[i]).lower()
+                    if len([f for f in filters if not f in text])>0:
+                        continue
+                result.append(i)
+                if len(result)>=limit:
+                    return True
+        return False
+
+    def entry(self,i):
+        """ Returns the (id,name,args,filepath) of an entry """
+        return (self.ids[i],self.names[i],self.args[i],self.files[self.fileIndex[i]])
+
+def symbolPath(indexPath):
+    """ The symbol index is stored next to the index database """
+    return os.path.splitext(indexPath)[0]+'.sym'
+
+def buildSymbols(index):
+    """ Build and save the symbol index of an Index """
+    symbols=SymbolIndex().build(index.symbolRows())
+    symbols.save(symbolPath(index.path))
+    return symbols
+
+def loadSymbols(index):
+    """ Load the saved symbol index of an Index, building it if missing """
+    if hasattr(index,'symbolIndex'):
+        # Searched by an index server
+        return index.symbolIndex()
+    path=symbolPath(index.path)
+    if os.path.exists(path):
+        return SymbolIndex().load(path)
+    return buildSymbols(index)
+
+def main():
+    import cbindex
+    index=cbindex.Index()
+    symbols=loadSymbols(index)
+    for i in symbols.search(' '.join(sys.argv[1:]),20):
+        id,name,args,filepath=symbols.entry(i)
+        print '{}{}  {}'.format(name,args,filepath)
+
+if __name__=='__main__':
+    main()
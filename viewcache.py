@@ -0,0 +1,83 @@
+from collections import OrderedDict
+import instrument
+
+
+class ViewCache:
+    """ Bounded LRU cache of prepared documents, keyed by source path
+
+    Documents keep their text, highlight spans and view state, so switching
+    back to a cached file needs no disk access or highlighting.  The least
+    recently used documents are dropped once either the entry count or
+    the estimated memory size goes over its limit.
+
+    Documents prefetched but not shown yet are limited to a quarter of the
+    entries over all visits, the oldest are dropped first, so prefetching
+    never pushes more than that out of the history of visited files.
+
+    """
+
+    def __init__(self,maxBytes=64*1024*1024,maxEntries=64):
+        self.maxBytes=maxBytes
+        self.maxEntries=maxEntries
+        self.entries=OrderedDict()
+        # Paths of the prefetched entries that were not shown yet
+        self.prefetched=set()
+        self.size=0
+        self.hits=0
+        self.misses=0
+
+    def setLimits(self,maxBytes,maxEntries=None):
+        self.maxBytes=maxBytes
+        if not maxEntries is None:
+            self.maxEntries=maxEntries
+        self.evict()
+
+    def get(self,path):
+        entry=self.entries.pop(path,None)
+        if entry is None:
+            self.misses+=1
+            instrument.count('viewcache.miss')
+            return None
+        self.hits+=1
+        instrument.count('viewcache.hit')
+        self.entries[path]=entry
+        self.prefetched.discard(path)
+        return entry[0]
+
+    def put(self,path,doc,prefetched=False):
+        self.remove(path)
+        size=doc.memorySize()
+        self.entries[path]=(doc,size)
+        self.size+=size
+        if prefetched:
+            self.prefetched.add(path)
+        self.evict()
+
+    def remove(self,path):
+        old=self.entries.pop(path,None)
+        if not old is None:
+            self.size-=old[1]
+        self.prefetched.discard(path)
+
+    def clear(self):
+        self.entries.clear()
+        self.prefetched.clear()
+        self.size=0
+
+    def evict(self):
+        while len(self.prefetched)>self.maxEntries/4:
+            oldest=[path for path in self.entries if path in self.prefetched][0]
+            self.remove(oldest)
+            instrument.count('viewcache.evict')
+        # Never drop the most recent entry, even if it is over the limit alone
+        while len(self.entries)>1 and (self.size>self.maxBytes or len(self.entries)>self.maxEntries):
+            path,entry=self.entries.popitem(last=False)
+            self.size-=entry[1]
+            self.prefetched.discard(path)
+            instrument.count('viewcache.evict')
+
+    def __contains__(self,path):
+        return path in self.entries
+
+    def __len__(self):
+        return len(self.entries)